@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import glob
+import os
+import time
+import pandas as pd
+import yaml
+
+from urclimask.catalog import FileCatalog
+from urclimask.mask_cache import MaskCache
+from urclimask.urban_areas import UrbanVicinity
+
+# Static fields location
+root_nextcloud = '/lustre/gmeteo/WORK/DATA/CORDEX-FPS-URB-RCC/nextcloud/CORDEX-CORE-WG/'
+root_esgf = "/lustre/gmeteo/DATA/ESGF/REPLICA/DATA/cordex/output/"
+# Masks are written in the layout of the masks/CORDEX-CMIP5/DD tree
+output_dir = 'results/masks/CORDEX-CMIP5/DD'
+mask_version = time.strftime('v%Y%m%d')
+# Static fields are r0i0p0 for some models; masks are named after the evaluation run
+run_ensemble = 'r1i1p1'
+# Masks of unchanged static fields and hyperparameters are not recomputed
+# (reported with status 'cached' in the summary)
+cache = MaskCache('results/mask_cache')
+
+# Load cities configuration from YAML
+with open('selected_cities.yaml') as f:
+    cities = yaml.safe_load(f)
+
+# One batch per domain/model/urban variable: static fields are opened only once
+pairs = sorted({
+    (cities[city]['domain'], city.split('_')[1], city.split('_')[2])
+    for city in cities if city != 'DEFAULT'
+})
+
+# Catalog of the ESGF replica (only the directories changed since the last run are scanned)
+catalog = FileCatalog(root_esgf).refresh()
+
+summaries = []
+for domain, model, urban_var in pairs:
+    file_sfturf = glob.glob(f"{root_nextcloud}{model}/{urban_var}/{urban_var}_{domain}*.nc")
+    # Latest version (and RCM version) of the static fields
+    entry_orog, entry_sftlf = [
+        catalog.latest(domain = domain, model = model, driving_model = 'ECMWF-ERAINT',
+                       experiment = 'evaluation', frequency = 'fx', variable = variable)
+        .sort_values(['version', 'rcm_version', 'path']).tail(1)
+        for variable in ('orog', 'sftlf')
+    ]
+    if not (file_sfturf and len(entry_orog) and len(entry_sftlf)):
+        print(f"Static fields not found for {domain} {model} ({urban_var})")
+        continue
+    entry_orog, entry_sftlf = entry_orog.iloc[0], entry_sftlf.iloc[0]
+    summary = UrbanVicinity.batch(
+        cities, domain, model,
+        sfturf_file = file_sfturf[0],
+        orog_file = entry_orog['path'],
+        sftlf_file = entry_sftlf['path'],
+        output_dir = output_dir,
+        drs = {**entry_orog.to_dict(), 'version': mask_version, 'run_ensemble': run_ensemble},
+        cache = cache,
+    )
+    summaries.append(summary.assign(domain = domain, model = model))
+
+if summaries:
+    os.makedirs(output_dir, exist_ok = True)
+    summary = pd.concat(summaries)
+    summary.to_csv(f"{output_dir}/summary.csv")
+    print(summary[summary['status'] != 'ok'][['domain', 'model', 'error']])
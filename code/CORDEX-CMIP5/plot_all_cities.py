@@ -3,6 +3,7 @@
 
 import glob
 import os
+import pandas as pd
 import papermill as pm
 import sys
 
@@ -14,9 +15,18 @@ from utils import YAMLconfig
 input_notebook = 'urban_area_selection.ipynb'
 output_notebook = 'urban_area_selection__papermill.ipynb'
 
-# Climate variable and expected output
+# Climate variable
 variable = 'tasmin'
-expected_figure_number = 7
+
+# Status of the masks in the last run of generate_all_masks.py. A city is run
+# again only if its plots were never completed or its mask was recomputed
+# ('ok', not 'cached') after them; cities without a mask ('error') are skipped
+mask_summary_file = 'results/masks/CORDEX-CMIP5/DD/summary.csv'
+if os.path.exists(mask_summary_file):
+    mask_status = pd.read_csv(mask_summary_file, index_col = 'city')['status'].to_dict()
+    mask_summary_time = os.path.getmtime(mask_summary_file)
+else:
+    mask_status, mask_summary_time = {}, 0
 
 # Load cities configuration from YAML
 cities = YAMLconfig('selected_cities.yaml')
@@ -70,7 +80,13 @@ for varible in ['tasmin', 'tasmax']:
     
         # Update directory to include urban variable
         directory = f"results/{parameters['urban_var']}_{abbr_city}-{domain}_{model_str}"
-        if len(glob.glob(f"{directory}/*.pdf")) == expected_figure_number:
+        done_file = f"{directory}/papermill.done"
+        status = mask_status.get(city)
+        if status == 'error':
+            print(f'Skipping {city}: the mask could not be computed')
+            continue
+        if os.path.exists(done_file) and not (
+                status == 'ok' and os.path.getmtime(done_file) < mask_summary_time):
             continue
     
         # Execute notebook using Papermill
@@ -81,6 +97,9 @@ for varible in ['tasmin', 'tasmax']:
                 parameters=parameters,
                 kernel_name='python3'
             )
+            os.makedirs(directory, exist_ok=True)
+            with open(done_file, 'w') as f:
+                f.write(f'{status}\n')
         except Exception as e:
             # Handle errors by saving a failed version of the output notebook
             output_notebook_failed = output_notebook.replace('.ipynb', f'_ERROR_{abbr_city}-{domain}_{model}.ipynb')
@@ -1,54 +1,318 @@
+import argparse
+import functools
+import os
+import time
 import pandas as pd
 import geopandas as gpd
 import xarray as xr
 import numpy as np
-from shapely.geometry import Point
+import pyarrow.parquet as pq
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+
+from urclimask.spatial_index import chord_to_km, EARTH_RADIUS_KM, get_grid_index, km_to_chord, lonlat_to_xyz
 
 var_map = {
     'tasmin': 'TMIN',
     'tasmax': 'TMAX'
 }
 
-def load_ghcnd_stations(lon, lat, radious = 0.5):
+# GHCNd station inventory (a local mirror can be set with GHCND_STATIONS_URL)
+GHCND_STATIONS_URL = os.environ.get(
+    'GHCND_STATIONS_URL',
+    'https://www.ncei.noaa.gov/data/global-historical-climatology-network-daily/doc/ghcnd-stations.txt'
+)
+# Directory of the GHCNd series ({code[0]}/{code}.csv.gz)
+GHCND_DATA_PATH = os.environ.get('GHCND_DATA_PATH', '/lustre/gmeteo/WORK/WWW/chus/ghcnd/data')
+# Partitioned Parquet store of the GHCNd series (disabled if not set)
+GHCND_STORE_PATH = os.environ.get('GHCND_STORE_PATH')
+# Elements kept in the Parquet store
+GHCND_ELEMENTS = ['PRCP', 'TAVG', 'TMAX', 'TMIN', 'SNWD']
+# Directory of the local inventory cache
+GHCND_CACHE_DIR = os.environ.get('URCLIMASK_CACHE_DIR', os.path.expanduser('~/.cache/urclimask'))
+
+def refresh_ghcnd_inventory(url = None, cache_dir = None):
+    '''
+    Download the GHCND station inventory and store it as a local Parquet file.
+
+    Parameters:
+    url (str): URL or path of ghcnd-stations.txt (GHCND_STATIONS_URL by default).
+    cache_dir (str): Directory of the local cache (GHCND_CACHE_DIR by default).
+
+    Returns:
+    str: Path of the Parquet inventory.
+    '''
+    cache_dir = cache_dir or GHCND_CACHE_DIR
+    ghcnd_stations_column_names = ['code', 'lat', 'lon', 'elev', 'name', 'net', 'numcode']
+    ghcnd_stations_column_widths = [   11,     9,    10,      7,     34,     4,       10 ]
+    df = pd.read_fwf(url or GHCND_STATIONS_URL, header = None, widths = ghcnd_stations_column_widths,
+                     names = ghcnd_stations_column_names,
+                     dtype = {'code': str, 'name': str, 'net': str})
+    os.makedirs(cache_dir, exist_ok = True)
+    inventory_file = os.path.join(cache_dir, 'ghcnd-stations.parquet')
+    tmp_file = f'{inventory_file}.{os.getpid()}.tmp'
+    df.to_parquet(tmp_file, index = False)
+    os.replace(tmp_file, inventory_file)
+    return inventory_file
+
+@functools.lru_cache(maxsize = 4)
+def _read_ghcnd_inventory(inventory_file, mtime):
+    df = pd.read_parquet(inventory_file)
+    tree = cKDTree(lonlat_to_xyz(df.lon.values, df.lat.values))
+    return df, tree
+
+def load_ghcnd_inventory(cache_dir = None):
+    '''
+    GHCND station inventory and its spatial index, from the local cache.
+
+    The inventory is downloaded (see `refresh_ghcnd_inventory`) only if it is
+    not in the cache. It is kept in memory together with a KD-tree on the unit
+    sphere (equivalent to a haversine BallTree) for the radius queries.
+
+    Parameters:
+    cache_dir (str): Directory of the local cache (GHCND_CACHE_DIR by default).
+
+    Returns:
+    tuple: (pd.DataFrame, scipy.spatial.cKDTree) inventory and spatial index.
+    '''
+    inventory_file = os.path.join(cache_dir or GHCND_CACHE_DIR, 'ghcnd-stations.parquet')
+    if not os.path.exists(inventory_file):
+        refresh_ghcnd_inventory(cache_dir = cache_dir)
+    return _read_ghcnd_inventory(inventory_file, os.path.getmtime(inventory_file))
+
+def load_ghcnd_stations(lon, lat, radious = 0.5, *, radius_km = None, cache_dir = None):
     '''
     Load GHCND stations near a specific location.
 
     Parameters:
     lon (float): Longitude of the selected city.
     lat (float): Latitude of the selected city.
-    radius (float): Maximum distance allowed.
+    radius (float): Maximum distance allowed (degrees).
+    radius_km (float): Maximum great-circle distance allowed (km). Overrides `radious`.
+    cache_dir (str): Directory of the local inventory cache.
 
     Returns:
     gpd.GeoDataFrame: Geospatial DataFrame of nearby GHCND stations.
     '''
-    ghcnd_stations_url = 'https://www.ncei.noaa.gov/data/global-historical-climatology-network-daily/doc/ghcnd-stations.txt'
-    ghcnd_stations_column_names = ['code', 'lat', 'lon', 'elev', 'name', 'net', 'numcode']
-    ghcnd_stations_column_widths = [   11,     9,    10,      7,     34,     4,       10 ]
-    df = pd.read_fwf(ghcnd_stations_url, header = 0, widths = ghcnd_stations_column_widths, names = ghcnd_stations_column_names)
-    ghcnd_stations=gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat), crs = 'EPSG:4326')
-    rval = ghcnd_stations.assign(dist = ghcnd_stations.distance(Point(lon, lat)))
-    rval.sort_values(by = 'dist', inplace = True)
-    rval = rval[rval.dist < radious].to_crs(epsg=3857)
-    return rval
+    return load_ghcnd_stations_batch(
+        {None: (lon, lat)}, radious = radious, radius_km = radius_km, cache_dir = cache_dir
+    ).drop(columns = 'city')
+
+def load_ghcnd_stations_batch(locations, radious = 0.5, *, radius_km = None, cache_dir = None):
+    '''
+    Load GHCND stations near several locations with a single index query.
+
+    Parameters:
+    locations (dict): Locations as {city: (lon, lat)}.
+    radius (float): Maximum distance allowed (degrees).
+    radius_km (float): Maximum great-circle distance allowed (km). Overrides `radious`.
+    cache_dir (str): Directory of the local inventory cache.
+
+    Returns:
+    gpd.GeoDataFrame: Nearby GHCND stations of every location, with a 'city'
+        column, sorted by city and distance. 'dist' is the distance in degrees
+        and 'dist_km' the great-circle distance.
+    '''
+    df, tree = load_ghcnd_inventory(cache_dir)
+    cities = list(locations)
+    lon, lat = np.array([locations[city] for city in cities], dtype = float).reshape(-1, 2).T
+    # Degree distances are bounded by the great-circle distance, so the index
+    # query is a superset that is then filtered
+    query_km = radius_km if radius_km is not None else radious * np.pi / 180 * EARTH_RADIUS_KM * (1 + 1e-9)
+    neighbours = tree.query_ball_point(lonlat_to_xyz(lon, lat), km_to_chord(query_km))
+    selected = []
+    for k, rows in enumerate(neighbours):
+        rval = df.iloc[np.sort(np.asarray(rows, dtype = int))].assign(city = cities[k])
+        rval['dist'] = np.hypot(rval.lon - lon[k], rval.lat - lat[k])
+        rval['dist_km'] = chord_to_km(np.linalg.norm(
+            lonlat_to_xyz(rval.lon.values, rval.lat.values) - lonlat_to_xyz(lon[k], lat[k]), axis = -1))
+        if radius_km is None:
+            rval = rval[rval.dist < radious]
+        selected.append(rval.sort_values(by = 'dist' if radius_km is None else 'dist_km', kind = 'stable'))
+    rval = pd.concat(selected)
+    ghcnd_stations = gpd.GeoDataFrame(rval, geometry = gpd.points_from_xy(rval.lon, rval.lat), crs = 'EPSG:4326')
+    return ghcnd_stations.to_crs(epsg = 3857)
 
-def get_ghcnd_df(code):
+def convert_ghcnd_to_parquet(codes, *, data_path = None, store_path = None,
+                             elements = GHCND_ELEMENTS, max_workers = 8):
+    '''
+    Convert GHCND station series ({code}.csv.gz) to a partitioned Parquet store.
+
+    The store holds the series in long format (station, date, element, value,
+    qflag) on the dates of the original file, partitioned by element and station prefix (country and network,
+    the first 3 characters of the code), one file per station sorted by date,
+    so reads by station, element and date range only touch the needed files
+    and row groups. Station names, locations and converted elements are kept in
+    'stations.parquet'. Converting a station again replaces its files.
+
+    Parameters:
+    codes (list): The station codes.
+    data_path (str): Directory of the GHCNd series (GHCND_DATA_PATH by default).
+    store_path (str): Directory of the Parquet store (GHCND_STORE_PATH by default).
+    elements (list): Elements to store.
+    max_workers (int): Maximum number of concurrent conversions.
+
+    Returns:
+    pd.DataFrame: Metadata of the converted stations.
+    '''
+    baseurl = data_path or GHCND_DATA_PATH
+    store_path = store_path or GHCND_STORE_PATH
+    columns = {'DATE', 'NAME', 'LATITUDE', 'LONGITUDE', 'ELEVATION',
+               *elements, *[f'{element}_ATTRIBUTES' for element in elements]}
+
+    def convert(code):
+        try:
+            df = pd.read_csv(f'{baseurl}/{code[0]}/{code}.csv.gz', compression = 'gzip',
+                             usecols = lambda column: column in columns, parse_dates = ['DATE'],
+                             dtype = {'NAME': str, **{element: 'float64' for element in elements},
+                                      **{f'{element}_ATTRIBUTES': str for element in elements}})
+        except Exception as e:
+            print(f"Error loading data for {code}: {e}")
+            return None
+        for element in elements:
+            if element not in df.columns:
+                continue
+            # Missing values are kept so the station keeps its date axis
+            values = df['DATE'].notna()
+            # Attributes are 'mflag,qflag,sflag[,time]'
+            qflag = df.loc[values, f'{element}_ATTRIBUTES'].str.split(',').str[1] \
+                if f'{element}_ATTRIBUTES' in df.columns else None
+            table = pd.DataFrame({
+                'station': code,
+                'date': df.loc[values, 'DATE'].values,
+                'value': df.loc[values, element].astype('float32').values,
+                'qflag': pd.Series(qflag, dtype = str).replace('', None).values if qflag is not None else None,
+            }).sort_values('date')
+            partition = os.path.join(store_path, f'element={element}', f'prefix={code[:3]}')
+            os.makedirs(partition, exist_ok = True)
+            table.to_parquet(os.path.join(partition, f'{code}.parquet'), index = False,
+                             compression = 'zstd', row_group_size = 4096)
+        return {'code': code, 'name': df['NAME'].iloc[0] if len(df) else None,
+                'lat': df['LATITUDE'].iloc[0] if len(df) else np.nan,
+                'lon': df['LONGITUDE'].iloc[0] if len(df) else np.nan,
+                'elev': df['ELEVATION'].iloc[0] if len(df) else np.nan,
+                'elements': ','.join(elements)}
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        converted = [row for row in executor.map(convert, list(dict.fromkeys(codes))) if row is not None]
+    metadata = pd.DataFrame(converted, columns = ['code', 'name', 'lat', 'lon', 'elev', 'elements'])
+    stations_file = os.path.join(store_path, 'stations.parquet')
+    os.makedirs(store_path, exist_ok = True)
+    stations = metadata
+    if os.path.exists(stations_file):
+        previous = pd.read_parquet(stations_file)
+        stations = pd.concat([previous[~previous.code.isin(metadata.code)], metadata], ignore_index = True)
+    tmp_file = f'{stations_file}.{os.getpid()}.tmp'
+    stations.sort_values('code').to_parquet(tmp_file, index = False)
+    os.replace(tmp_file, stations_file)
+    _read_ghcnd_store_stations.cache_clear()
+    return metadata
+
+@functools.lru_cache(maxsize = 4)
+def _read_ghcnd_store_stations(store_path):
+    stations_file = os.path.join(store_path, 'stations.parquet')
+    if not os.path.exists(stations_file):
+        return pd.DataFrame(columns = ['code', 'name', 'lat', 'lon', 'elev', 'elements']).set_index('code')
+    stations = pd.read_parquet(stations_file).set_index('code')
+    if 'elements' not in stations.columns:
+        # Stores written before the elements were recorded
+        stations['elements'] = ''
+    stations['elements'] = stations['elements'].fillna('')
+    return stations
+
+def _in_ghcnd_store(store_path, code, elements):
+    # The store is used only if all the elements were converted for the station
+    stations = _read_ghcnd_store_stations(store_path)
+    if code not in stations.index:
+        return False
+    return set(elements) <= set(stations.loc[code, 'elements'].split(','))
+
+def read_ghcnd_store(codes, elements, idate = None, fdate = None, *, store_path = None):
+    '''
+    Read GHCND series from the Parquet store.
+
+    Only the files of the requested elements and stations are opened, and the
+    date filters are pushed down to the Parquet row group statistics.
+
+    Parameters:
+    codes (list): The station codes.
+    elements (list): Elements to read (e.g. ['TMIN', 'TMAX']).
+    idate (str): First date to read (optional).
+    fdate (str): Last date to read (optional).
+    store_path (str): Directory of the Parquet store (GHCND_STORE_PATH by default).
+
+    Returns:
+    pd.DataFrame: Long frame with station, date, element, value and qflag.
+    '''
+    store_path = store_path or GHCND_STORE_PATH
+    tables = [_read_ghcnd_store_file(store_path, element, code, idate, fdate).assign(element = element)
+              for element in elements for code in dict.fromkeys(codes)]
+    tables = [table for table in tables if len(table)]
+    if not tables:
+        return pd.DataFrame(columns = ['station', 'date', 'element', 'value', 'qflag'])
+    return pd.concat(tables, ignore_index = True)[['station', 'date', 'element', 'value', 'qflag']]
+
+def _read_ghcnd_store_file(store_path, element, code, idate = None, fdate = None, columns = None):
+    # Partition pruning: only the file of the element and station is opened,
+    # and the dates are filtered with the row group statistics
+    path = os.path.join(store_path, f'element={element}', f'prefix={code[:3]}', f'{code}.parquet')
+    if not os.path.exists(path):
+        return pd.DataFrame(columns = columns or ['station', 'date', 'value', 'qflag'])
+    filters = []
+    if idate is not None:
+        filters.append(('date', '>=', pd.Timestamp(idate)))
+    if fdate is not None:
+        filters.append(('date', '<=', pd.Timestamp(fdate)))
+    return pq.read_table(path, columns = columns, filters = filters or None).to_pandas()
+
+def get_ghcnd_df(code, elements = None, *, data_path = None, store_path = None,
+                 idate = None, fdate = None):
     '''
     Load GHCND data for a specific station.
 
+    Stations converted to the Parquet store (see `convert_ghcnd_to_parquet`)
+    are read from it when `elements` are given and all of them were converted;
+    the rest from the CSV files.
+
     Parameters:
     code (str): The station code.
+    elements (list): Elements to read (e.g. ['TMIN', 'TMAX']). All columns by default.
+    data_path (str): Directory of the GHCNd series (GHCND_DATA_PATH by default).
+    store_path (str): Directory of the Parquet store (GHCND_STORE_PATH by default).
+    idate (str): First date to read from the Parquet store (optional).
+    fdate (str): Last date to read from the Parquet store (optional).
 
     Returns:
     pd.DataFrame: DataFrame containing the GHCND data for the specified station.
     '''
-    baseurl = '/lustre/gmeteo/WORK/WWW/chus/ghcnd/data'# GHCNd series
+    store_path = store_path or GHCND_STORE_PATH
+    if elements is not None and store_path and _in_ghcnd_store(store_path, code, elements):
+        series = {
+            element: _read_ghcnd_store_file(store_path, element, code, idate, fdate,
+                                            columns = ['date', 'value']).set_index('date')['value']
+            for element in elements
+        }
+        rval = pd.DataFrame({element: values for element, values in series.items() if len(values)},
+                            dtype = 'float64')
+        rval.index.name = 'DATE'
+        rval.insert(0, 'NAME', _read_ghcnd_store_stations(store_path).loc[code, 'name'])
+        return rval
+    baseurl = data_path or GHCND_DATA_PATH # GHCNd series
+    if elements is None:
+        read_kwargs = dict(low_memory=False) # Avoid warnings for mixed data types in some columns
+    else:
+        # Only DATE, NAME and the requested elements are parsed
+        columns = {'DATE', 'NAME', *elements}
+        read_kwargs = dict(usecols=lambda column: column in columns,
+                           dtype={'NAME': str, **{element: 'float64' for element in elements}})
     try:
         # Attempt to load the compressed file from the original location
         rval = pd.read_csv(f'{baseurl}/{code[0]}/{code}.csv.gz',
                            compression='gzip',
                            index_col='DATE',
                            parse_dates=True,
-                           low_memory=False  # Avoid warnings for mixed data types in some columns
+                           **read_kwargs
                            )
 
     except Exception as e:
@@ -58,66 +322,151 @@ def get_ghcnd_df(code):
 
     return rval
 
-def get_valid_timeseries(city, stations, ds_var, series = None, variable = 'tasmin', valid_threshold=0.8, idate='1979-01-01', fdate='2014-12-31',var_map=var_map, divide=10.0):
+def _load_ghcnd_stations_data(codes, elements = None, *, data_path = None, store_path = None,
+                              idate = None, fdate = None, max_workers = 8):
+    # Read the series of several stations over a bounded thread pool (I/O bound)
+    def load(code):
+        start = time.perf_counter()
+        rval = get_ghcnd_df(code, elements, data_path = data_path, store_path = store_path,
+                            idate = idate, fdate = fdate)
+        return rval, time.perf_counter() - start
+
+    codes = list(dict.fromkeys(codes))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        results = list(executor.map(load, codes))
+    elapsed = time.perf_counter() - start
+    data = {code: rval for code, (rval, _) in zip(codes, results)}
+    timings = pd.DataFrame({
+        'seconds': [seconds for _, seconds in results],
+        'rows': [len(rval) for rval, _ in results],
+    }, index = pd.Index(codes, name = 'code'))
+    print(f"Loaded {len(codes)} GHCND stations ({timings.rows.sum()} records) in {elapsed:.2f} s "
+          f"({len(codes) / elapsed if elapsed else np.inf:.1f} stations/s, "
+          f"slowest {timings.seconds.max() if codes else 0:.2f} s)")
+    return data, timings
+
+def get_ghcnd_dfs(codes, elements, *, data_path = None, store_path = None, max_workers = 8, long = False):
+    '''
+    Load the GHCND data of several stations concurrently.
+
+    Parameters:
+    codes (list): The station codes.
+    elements (list): Elements to read (e.g. ['TMIN', 'TMAX', 'PRCP']).
+    data_path (str): Directory of the GHCNd series (GHCND_DATA_PATH by default).
+    store_path (str): Directory of the Parquet store (GHCND_STORE_PATH by default).
+    max_workers (int): Maximum number of concurrent reads.
+    long (bool): Return a long frame (code, DATE, element, value) instead of a wide one.
+
+    Returns:
+    pd.DataFrame: Wide frame indexed by DATE with (element, code) columns, or a
+        long frame. The per-station read times are in `attrs['timings']`.
+    '''
+    data, timings = _load_ghcnd_stations_data(codes, elements, data_path = data_path,
+                                               store_path = store_path, max_workers = max_workers)
+    frames = {code: rval[[element for element in elements if element in rval.columns]]
+              for code, rval in data.items() if not rval.empty}
+    if frames:
+        rval = pd.concat(frames, axis = 1, names = ['code', 'element'])
+        rval = rval.swaplevel(axis = 1).sort_index(axis = 1)
+    else:
+        rval = pd.DataFrame(columns = pd.MultiIndex.from_arrays([[], []], names = ['element', 'code']))
+    if long:
+        rval = (rval.stack(['code', 'element'], future_stack = True).dropna()
+                .rename('value').reset_index()[['code', 'DATE', 'element', 'value']]
+                .sort_values(['code', 'DATE', 'element'], ignore_index = True))
+    rval.attrs['timings'] = timings
+    return rval
+
+def get_valid_timeseries(city, stations, ds_var, series = None, variable = 'tasmin', valid_threshold=0.8, idate='1979-01-01', fdate='2014-12-31',var_map=var_map, divide=10.0, *, data_path=None, store_path=None, max_workers=8):
     '''
     Retrieves valid time series data for a specific variable from GHCND stations for a given city.
 
+    The station data is read once and the coverage of every station and
+    variable is computed in a single groupby over a long-format table.
+
     Parameters:
     city (str): The name of the city for which the data is to be retrieved.
     stations (GeoDataFrame): A GeoDataFrame containing station metadata.
     series (DataFrame): Time series from other source different than GHCNd
-    var (str): The variable of interest (default is 'PRCP' for precipitation).
+    variable (str or list): The variable(s) of interest (e.g. 'tasmin' or ['tasmin', 'tasmax']).
     valid_threshold (float): The threshold proportion of valid records required (default is 0.8).
     idate (str): The start date for the period of interest (default is '1979-01-01').
     fdate (str): The end date for the period of interest (default is '2014-12-31').
     var_map (dict): A dictionary mapping the variable names from the input to the dataset variable names.
+    data_path (str): Directory of the GHCNd series (GHCND_DATA_PATH by default).
+    store_path (str): Directory of the Parquet store (GHCND_STORE_PATH by default).
+    max_workers (int): Maximum number of concurrent station reads.
     
     Returns:
     tuple: A tuple containing:
         - GeoDataFrame: The subset of stations with valid data.
         - pd.DataFrame: A DataFrame of valid time series data.
         - xr.Dataset: The subset of the dataset containing the selected period.
+        If `variable` is a list, the first two items are dicts keyed by variable.
     '''
-    var = var_map.get(variable, None)
+    variables = [variable] if isinstance(variable, str) else list(variable)
+    elements = {var_map.get(var, None): var for var in variables}
     period = slice(idate, fdate)
     ds_var_period=ds_var.sel(time=period)
     ndays = (pd.to_datetime(fdate)-pd.to_datetime(idate)).days
-    valid_codes, valid_time_series = [], []
-    for stn_code in stations.code:
-        if series is None:
-            stn_data = get_ghcnd_df(stn_code)
-        elif isinstance(series, pd.DataFrame):
-            stn_data = series[series['code'] == int(stn_code)]
-        if stn_data.empty:
-            continue
-        availvars = available_vars(stn_data)
-        if var in availvars:
-
-            valid_records = stn_data[var].loc[period].notna().sum()/ndays
-
-            if valid_records > valid_threshold:
-                print(f'{city} -- {stn_data.NAME[0]} - {var} has {100*valid_records:.1f}% valid records in {idate} to {fdate}')
-                valid_codes.append(stn_code)
-                valid_time_series.append({'data':stn_data[var].loc[period]/divide,'code':stn_code})
-
-    #convert list in a dataframe
-    if valid_time_series:
-        for n_s, serie in enumerate(valid_time_series):
-            if n_s == 0:
-                freq = xr.infer_freq(serie['data'].index)
-                df_time_series_obs = pd.DataFrame(
-                        index = pd.date_range(period.start, period.stop, 
-                        freq = freq)
-                    )
-            serie['data'].index = pd.to_datetime(serie['data'].index)
-
-            serie['data'] = serie['data'].reindex(df_time_series_obs.index)
-            df_time_series_obs[serie['code']] = serie['data']
+    codes = list(stations.code)
+    if series is None:
+        stations_data, _ = _load_ghcnd_stations_data(codes, list(elements), data_path = data_path,
+                                                     store_path = store_path, idate = idate,
+                                                     fdate = fdate, max_workers = max_workers)
+    elif isinstance(series, pd.DataFrame):
+        series_by_code = dict(list(series.groupby('code')))
+        stations_data = {code: series_by_code.get(int(code), series.iloc[:0]) for code in codes}
 
+    # Long table (code, DATE, element, value) of the period
+    frames = {
+        code: stn_data[[element for element in elements if element in stn_data.columns]].loc[period]
+        for code, stn_data in stations_data.items() if not stn_data.empty
+    }
+    frames = {code: frame for code, frame in frames.items() if frame.shape[1]}
+    if frames:
+        long = (pd.concat(frames, names = ['code', 'DATE'])
+                .rename_axis(columns = 'element').stack(future_stack = True)
+                .rename('value').dropna().reset_index())
+        long['DATE'] = pd.to_datetime(long['DATE'])
     else:
-        df_time_series_obs = valid_time_series
-        
-    return(stations[stations.code.isin(valid_codes)], df_time_series_obs, ds_var_period)
+        long = pd.DataFrame({'code': [], 'DATE': pd.to_datetime([]), 'element': [], 'value': []})
+
+    # Fraction of valid records of every station and variable
+    coverage = long.groupby(['element', 'code']).size() / ndays
+    valid = coverage[coverage > valid_threshold]
+    valid = valid.reindex([(element, code) for element in elements for code in codes
+                           if (element, code) in valid.index])
+    for (element, code), valid_records in valid.items():
+        print(f'{city} -- {stations_data[code].NAME.iloc[0]} - {element} has {100*valid_records:.1f}% valid records in {idate} to {fdate}')
+
+    # Assemble the output with a single pivot
+    long = long.set_index(['element', 'code'])
+    long = long[long.index.isin(valid.index)].reset_index()
+    wide = long.pivot(index = 'DATE', columns = ['element', 'code'], values = 'value') / divide
+    if len(long):
+        dates = np.unique(long['DATE'].values)
+        step = np.diff(dates).min() if dates.size > 1 else np.timedelta64(1, 'D')
+        # Daily (or multi-day) steps are kept as calendar days
+        one_day = np.timedelta64(1, 'D')
+        freq = f'{step // one_day}D' if step % one_day == 0 else pd.Timedelta(step)
+        index = pd.date_range(period.start, period.stop, freq = freq)
+    valid_stations, valid_time_series = {}, {}
+    for element, var in elements.items():
+        valid_codes = [code for (valid_element, code) in valid.index if valid_element == element]
+        valid_stations[var] = stations[stations.code.isin(valid_codes)]
+        if valid_codes:
+            df_time_series_obs = wide[element][valid_codes].reindex(index)
+            df_time_series_obs.columns.name = None
+            df_time_series_obs.index.name = None
+        else:
+            df_time_series_obs = []
+        valid_time_series[var] = df_time_series_obs
+
+    if isinstance(variable, str):
+        return(valid_stations[variable], valid_time_series[variable], ds_var_period)
+    return(valid_stations, valid_time_series, ds_var_period)
 
 
 def available_vars(station):
@@ -133,19 +482,37 @@ def available_vars(station):
     return(set(station.columns).intersection({'PRCP', 'TAVG', 'TMAX', 'TMIN', 'SNWD'}))
 
 
-def inside_city(valid_obs, ucdb_city):
+def inside_city(valid_obs, ucdb_city, *, urmask = None):
     """
     Add a column to the dataframe with the atributes of the series 
     including in they are inside or outside the city.
-    """
 
-    valid_obs['inside_city'] = np.nan
-    for index, obs in valid_obs.iterrows():
-        # Create a point with latitude and longuitude
-        point = Point(obs['lon'], obs['lat'])
-        is_inside = ucdb_city.contains(point)
-        # Clasify in urban and vicinity
-        valid_obs.loc[valid_obs['code'].str.contains(obs.code), 'inside_city'] = is_inside.values[0]
+    Stations are classified at once with a point-in-polygon test on the
+    (prepared) UCDB city geometry or, if `urmask` is given, by the urmask
+    cell they fall in (urban: inside, vicinity: outside, rest: NaN). Stations
+    farther than one grid spacing from the closest cell center are off the
+    grid and get NaN.
+
+    Parameters:
+    valid_obs (DataFrame): Stations with 'lon' and 'lat' columns.
+    ucdb_city (GeoDataFrame): UCDB city polygon (EPSG:4326).
+    urmask (xr.DataArray or xr.Dataset): Urban/vicinity mask to classify the stations with.
+    """
+    if urmask is not None:
+        if isinstance(urmask, xr.Dataset):
+            urmask = urmask['urmask']
+        index = get_grid_index(urmask.lon.values, urmask.lat.values)
+        iy, ix, distance = index.query(valid_obs['lon'].values, valid_obs['lat'].values,
+                                       return_distance = True)
+        cell = np.where(distance <= index.spacing, urmask.values[iy, ix], np.nan)
+        is_inside = np.full(cell.shape, np.nan, dtype = object)
+        is_inside[cell == 1] = True
+        is_inside[cell == 0] = False
+    else:
+        city = ucdb_city.geometry.iloc[0]
+        shapely.prepare(city)
+        is_inside = shapely.contains_xy(city, valid_obs['lon'].values, valid_obs['lat'].values)
+    valid_obs['inside_city'] = is_inside
 
     n_series_inside = (valid_obs['inside_city'].values == True).sum()
     n_series_ouside = (valid_obs['inside_city'].values == False).sum()
@@ -159,3 +526,24 @@ def inside_city(valid_obs, ucdb_city):
     return valid_obs
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Manage the local GHCND station inventory.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    refresh = subparsers.add_parser('refresh', help = 'Download the station inventory to the local cache.')
+    refresh.add_argument('--url', default = None, help = 'URL or path of ghcnd-stations.txt (mirror).')
+    refresh.add_argument('--cache-dir', default = None, help = 'Directory of the local cache.')
+    convert = subparsers.add_parser('convert', help = 'Convert station series to the Parquet store.')
+    convert.add_argument('codes', nargs = '*', help = 'Station codes (all the stations in the data path by default).')
+    convert.add_argument('--data-path', default = None, help = 'Directory of the GHCNd series.')
+    convert.add_argument('--store-path', default = None, help = 'Directory of the Parquet store.')
+    args = parser.parse_args()
+    if args.command == 'refresh':
+        print(refresh_ghcnd_inventory(url = args.url, cache_dir = args.cache_dir))
+    elif args.command == 'convert':
+        codes = args.codes or sorted(
+            file[:-len('.csv.gz')]
+            for _, _, files in os.walk(args.data_path or GHCND_DATA_PATH)
+            for file in files if file.endswith('.csv.gz')
+        )
+        metadata = convert_ghcnd_to_parquet(codes, data_path = args.data_path, store_path = args.store_path)
+        print(f"Converted {len(metadata)} stations")
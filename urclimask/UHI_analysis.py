@@ -1,13 +1,92 @@
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
+import dask.array
 import numpy as np
 import os
 import pandas as pd
+import warnings
 import xarray as xr
 from icecream import ic
-from itertools import product
+from matplotlib.collections import LineCollection
+from urclimask.spatial_index import get_grid_index
 from urclimask.urban_areas import plot_urban_polygon
 
+PERIOD_MONTHS = {'jja': [6, 7, 8], 'djf': [12, 1, 2]}
+
+# Percentile bands precomputed for the cycle plots (and their complements)
+CYCLE_PERCENTILES = [5, 10, 25]
+
+
+def _month_hour_block(values, group, ngroups):
+    """
+    Sums and counts of the valid values of a block per group.
+
+    Parameters:
+    values (numpy.ndarray): Block with time as the first dimension.
+    group (numpy.ndarray): Group number of each time step (broadcastable to values).
+    ngroups (int): Number of groups.
+
+    Returns:
+    numpy.ndarray: Array (2, ngroups, ...) with the sums and the counts.
+    """
+    group = group.reshape(-1)
+    result = np.zeros((2, ngroups) + values.shape[1:])
+    if values.shape[0] == 0:
+        return result
+    order = np.argsort(group, kind = 'stable')
+    present, starts = np.unique(group[order], return_index = True)
+    values = values[order]
+    valid = ~np.isnan(values)
+    result[0, present] = np.add.reduceat(np.where(valid, values, 0), starts, axis = 0)
+    result[1, present] = np.add.reduceat(valid, starts, axis = 0)
+    return result
+
+
+def month_hour_sums(da):
+    """
+    Sums and counts of the valid values of each grid cell per (month, hour) of the time steps.
+
+    The reduction is done block by block along time, so a dask-backed array is
+    read only once and the memory is bounded by one chunk.
+
+    Parameters:
+    da (xarray.DataArray): Data with a 'time' dimension.
+
+    Returns:
+    tuple: (sums, counts) DataArrays with a 'group' dimension (with 'month'
+    and 'hour' coordinates) instead of 'time'.
+    """
+    da = da.transpose('time', ...)
+    month_hour = (da['time'].dt.month * 24 + da['time'].dt.hour).values
+    keys, group = np.unique(month_hour, return_inverse = True)
+    ngroups = keys.size
+
+    data = da.data
+    if isinstance(data, dask.array.Array):
+        group = dask.array.from_array(group, chunks = (data.chunks[0],))
+        group = group.reshape((-1,) + (1,) * (data.ndim - 1))
+        blocks = dask.array.map_blocks(
+            _month_hour_block, data, group,
+            ngroups = ngroups,
+            new_axis = 0,
+            chunks = ((2,), (ngroups,) * data.numblocks[0]) + data.chunks[1:],
+            dtype = float,
+        )
+        nblocks = data.numblocks[0]
+        result = blocks.reshape((2, nblocks, ngroups) + data.shape[1:]).sum(axis = 1).compute()
+    else:
+        result = _month_hour_block(np.asarray(data), group, ngroups)
+
+    template = da.isel(time = 0, drop = True)
+    coords = dict(template.coords, month = ('group', keys // 24), hour = ('group', keys % 24))
+    sums, counts = [
+        xr.DataArray(values, dims = ('group',) + template.dims, coords = coords,
+                     name = da.name, attrs = da.attrs)
+        for values in result
+    ]
+    return sums, counts
+
+
 class UrbanIsland:
     def __init__(
         self,
@@ -36,6 +115,46 @@ class UrbanIsland:
         self.period = period
         self.obs_attr = obs_attributes
         self.obs_time = obs_timeseries
+        self._cell_index = None
+
+    @property
+    def cell_index(self):
+        """
+        Flat indices (over the Y/X grid of `ds`) of the urban and vicinity cells,
+        computed once from the urban mask: {'urban': ndarray, 'rural': ndarray}.
+        """
+        if self._cell_index is None:
+            urmask = self.urban_vicinity['urmask']
+            spatial_dims = [self.ds.cf['Y'].name, self.ds.cf['X'].name]
+            urmask = urmask.isel({dim: 0 for dim in urmask.dims if dim not in spatial_dims})
+            values = urmask.transpose(*spatial_dims).values
+            self._cell_index = {
+                'urban': np.flatnonzero(values == 1),
+                'rural': np.flatnonzero(values == 0),
+                'shape': values.shape,
+            }
+        return self._cell_index
+
+    def gather_cells(self, da, kind):
+        """
+        Selects the urban or vicinity cells of a field.
+
+        Only the selected cells are read (an indexed gather on the Y/X
+        dimensions), so the cost scales with the number of masked cells instead
+        of the size of the domain.
+
+        Parameters:
+        - da (xarray.DataArray): Field on the grid of `ds`.
+        - kind (str): 'urban' or 'rural'.
+
+        Outputs:
+        - xarray.DataArray with a 'cell' dimension replacing the Y/X dimensions.
+        """
+        iy, ix = np.unravel_index(self.cell_index[kind], self.cell_index['shape'])
+        return da.isel({
+            self.ds.cf['Y'].name: xr.DataArray(iy, dims = 'cell'),
+            self.ds.cf['X'].name: xr.DataArray(ix, dims = 'cell'),
+        })
 
     def compute_spatial_climatology(self):
         """
@@ -48,29 +167,50 @@ class UrbanIsland:
         """
         # calculate climatology and anomaly from the model
         ds_var_period_mean = self.ds.mean('time').compute()
-        rural_mean = ds_var_period_mean.where(
-            self.urban_vicinity['urmask'] == 0).mean().compute()
+        rural_mean = UrbanIsland.gather_cells(self, ds_var_period_mean, 'rural').mean().compute()
         ds_anomaly = ds_var_period_mean - rural_mean        
         ds_anomaly.attrs['units'] = self.ds.attrs.get('units', 'unknown')
 
-        # calculate climatology from the observations
-        obs_anomaly = None
-        if not self.obs_attr.empty:
-            obs_period_mean = self.obs_time.mean()
-            obs_codes = self.obs_attr.loc[self.obs_attr["inside_city"] == False, "code"].astype(str)
-            
-            obs_rur_mean = obs_period_mean[obs_codes].mean( skipna = True)
-            obs_anomaly = (obs_period_mean - obs_rur_mean)
-
         if self.anomaly == 'rel':
             ds_anomaly = (ds_anomaly/ds_var_period_mean)*100
             ds_anomaly.attrs['units'] = "%"
-            if obs_anomaly is not None:
-                obs_anomaly = (obs_anomaly/obs_period_mean)*100
 
         self.ds_spatial_climatology = ds_anomaly.compute()
+        obs_anomaly = UrbanIsland._obs_spatial_climatology(self)
         if obs_anomaly is not None:
             self.obs_spatial_climatology = obs_anomaly
+
+    def _obs_spatial_climatology(self):
+        # calculate climatology from the observations
+        if self.obs_attr.empty:
+            return None
+        obs_period_mean = self.obs_time.mean()
+        obs_codes = self.obs_attr.loc[self.obs_attr["inside_city"] == False, "code"].astype(str)
+
+        obs_rur_mean = obs_period_mean[obs_codes].mean( skipna = True)
+        obs_anomaly = (obs_period_mean - obs_rur_mean)
+        if self.anomaly == 'rel':
+            obs_anomaly = (obs_anomaly/obs_period_mean)*100
+        return obs_anomaly
+
+    def _obs_cycle(self, by):
+        # calculate the cycle (grouped by 'month' or 'hour') from the observations
+        if self.obs_attr.empty:
+            return None
+        groups = getattr(self.obs_time.index, by)
+        codes_ins_city = self.obs_attr.code[self.obs_attr['inside_city'] == True]
+        codes_out_city = self.obs_attr.code[self.obs_attr['inside_city'] == False]
+        obs_group = self.obs_time.groupby(groups).mean()
+        obs_group_mean = pd.DataFrame(index = obs_group.index)
+        obs_group_mean['rural_mean'] = obs_group[codes_out_city].mean(axis = 1).values
+        obs_group_mean['urban_mean'] = obs_group[codes_ins_city].mean(axis = 1).values
+        obs_anomaly = obs_group_mean.sub(obs_group_mean['rural_mean'], axis = 0)
+        raw_anomaly = obs_group.sub(obs_group_mean['rural_mean'], axis = 0)
+        for code in obs_group.columns:
+            obs_anomaly[code] = raw_anomaly[code]
+        if self.anomaly == 'rel':
+            obs_anomaly = obs_anomaly.div(obs_group_mean['rural_mean'], axis = 0) * 100
+        return obs_anomaly
         
         
     def compute_annual_cycle(self):
@@ -82,40 +222,22 @@ class UrbanIsland:
         - self.ds_annual_cycle: Monthly anomaly for each month of the year from the model.
         - self.obs_annual_cycle: Monthly anomaly for each month of the year from the observation (if available).
         """
-        is_rural = self.urban_vicinity['urmask'] == 0
-        is_urban = self.urban_vicinity['urmask'] == 1
-        rural_mean = (self.ds
-            .where(is_rural)
+        rural_mean = (UrbanIsland.gather_cells(self, self.ds, 'rural')
             .groupby('time.month')
-            .mean(dim = [self.ds.cf['Y'].name, self.ds.cf['X'].name, 'time'])
+            .mean(dim = ['cell', 'time'])
             .compute()
         )       
         ds_period_mean = self.ds.groupby('time.month').mean('time')                  
         ds_anomaly = (ds_period_mean - rural_mean).compute()
         ds_anomaly.attrs['units'] = self.ds.attrs.get('units', 'unknown')
 
-        # calculate climatology from the observations
-        obs_anomaly = None
-        if not self.obs_attr.empty:
-            codes_ins_city = self.obs_attr.code[self.obs_attr['inside_city'] == True]
-            codes_out_city = self.obs_attr.code[self.obs_attr['inside_city'] == False]
-            obs_month = self.obs_time.groupby(self.obs_time.index.month).mean()
-            obs_month_mean = pd.DataFrame(index = obs_month.index)
-            obs_month_mean['rural_mean'] = obs_month[codes_out_city].mean(axis = 1).values
-            obs_month_mean['urban_mean'] = obs_month[codes_ins_city].mean(axis = 1).values
-            obs_anomaly = obs_month_mean.sub(obs_month_mean['rural_mean'], axis = 0)
-            raw_anomaly = obs_month.sub(obs_month_mean['rural_mean'], axis=0)
-            for code in obs_month.columns:
-                obs_anomaly[code] = raw_anomaly[code]
-
         if self.anomaly == 'rel':
             ds_anomaly = (ds_anomaly / ds_period_mean) * 100
             ds_anomaly.attrs['units'] = "%"
-            if obs_anomaly is not None:
-                obs_anomaly = obs_anomaly.div(obs_month_mean['rural_mean'], axis=0) * 100
 
         self.ds_annual_cycle = ds_anomaly
-        self.obs_annual_cycle = obs_anomaly
+        self.annual_cycle_summary = UrbanIsland.summarize_cycle(self, ds_anomaly)
+        self.obs_annual_cycle = UrbanIsland._obs_cycle(self, 'month')
     
     
     def compute_daily_cycle(self):
@@ -133,15 +255,12 @@ class UrbanIsland:
         elif self.period == 'djf':
             ds_var = ds_var.sel(time=ds_var['time'].dt.month.isin([12, 1, 2]))
     
-        is_rural = self.urban_vicinity['urmask'] == 0
-        is_urban = self.urban_vicinity['urmask'] == 1
         rounded_time = ds_var.time.dt.round('h')
         ds_var = ds_var.assign_coords(hour=rounded_time.dt.hour)
         rural_mean = (
-            ds_var
-            .where(is_rural)
+            UrbanIsland.gather_cells(self, ds_var, 'rural')
             .groupby('time.hour')
-            .mean(dim=[ds_var.cf['Y'].name, ds_var.cf['X'].name, 'time'])
+            .mean(dim=['cell', 'time'])
             .compute()
         )
     
@@ -150,31 +269,230 @@ class UrbanIsland:
         ds_anomaly = (ds_period_mean - rural_mean).compute()
         ds_anomaly.attrs['units'] = ds_var.attrs.get('units', 'unknown')
     
-        obs_anomaly = None
-    
-        if not self.obs_attr.empty:    
-            codes_ins_city = self.obs_attr.code[self.obs_attr['inside_city'] == True]
-            codes_out_city = self.obs_attr.code[self.obs_attr['inside_city'] == False]
-    
-            obs_hour = self.obs_time.groupby(self.obs_time.index.hour).mean()
-    
-            obs_hour_mean = pd.DataFrame(index=obs_hour.index)
-            obs_hour_mean['rural_mean'] = obs_hour[codes_out_city].mean(axis=1).values
-            obs_hour_mean['urban_mean'] = obs_hour[codes_ins_city].mean(axis=1).values
-    
-            obs_anomaly = obs_hour_mean.sub(obs_hour_mean['rural_mean'], axis=0)
-            raw_anomaly = obs_hour.sub(obs_hour_mean['rural_mean'], axis=0)
-            for code in obs_hour.columns:
-                obs_anomaly[code] = raw_anomaly[code]
-    
         if self.anomaly == 'rel':
             ds_anomaly = (ds_anomaly / ds_period_mean) * 100
             ds_anomaly.attrs['units'] = "%"
-            if obs_anomaly is not None:
-                obs_anomaly = obs_anomaly.div(obs_hour_mean['rural_mean'], axis=0) * 100
     
         self.ds_daily_cycle = ds_anomaly
-        self.obs_daily_cycle = obs_anomaly
+        self.daily_cycle_summary = UrbanIsland.summarize_cycle(self, ds_anomaly)
+        self.obs_daily_cycle = UrbanIsland._obs_cycle(self, 'hour')
+
+    def compute_all(self, *, accumulator = None):
+        """
+        Computes the spatial climatology, the annual cycle and the daily cycle
+        (and their anomalies) reading the model dataset only once.
+
+        A single dask graph accumulates the sums and counts of valid values of
+        every grid cell per (month, hour) group, chunk by chunk along time. The
+        three climatologies and their rural baselines are then derived from
+        these (small) aggregates.
+
+        Parameters:
+        - accumulator (ClimatologyAccumulator, optional): Accumulated state of the
+          model data on the grid of `ds`. If provided, the sums and counts are
+          taken from it and the data of `ds` are not read. A ValueError is raised
+          if its grid coordinates or units differ from those of `ds`.
+
+        Output:
+        - self.ds_spatial_climatology, self.ds_annual_cycle, self.ds_daily_cycle
+          (and the corresponding observation attributes, if available), as
+          computed by the individual methods.
+        """
+        if accumulator is not None:
+            state = accumulator.state
+            for axis in ('Y', 'X'):
+                name = self.ds.cf[axis].name
+                if name not in state.coords or not np.array_equal(state[name].values, self.ds[name].values):
+                    raise ValueError(f"The accumulator grid does not match the dataset ('{name}' differs)")
+            if state.attrs.get('units') != self.ds.attrs.get('units'):
+                raise ValueError(f"The accumulator units ({state.attrs.get('units')}) do not match "
+                                 f"the dataset units ({self.ds.attrs.get('units')})")
+            sums, counts = accumulator.group_sums()
+        else:
+            sums, counts = month_hour_sums(self.ds)
+        units = self.ds.attrs.get('units', 'unknown')
+
+        # Spatial climatology: rural baseline is the mean of the rural cell climatologies
+        ds_period_mean = sums.sum('group') / counts.sum('group')
+        rural_mean = UrbanIsland.gather_cells(self, ds_period_mean, 'rural').mean()
+        ds_anomaly = ds_period_mean - rural_mean
+        ds_anomaly.attrs['units'] = units
+        if self.anomaly == 'rel':
+            ds_anomaly = (ds_anomaly/ds_period_mean)*100
+            ds_anomaly.attrs['units'] = "%"
+        self.ds_spatial_climatology = ds_anomaly
+
+        # Annual and daily cycles: rural baseline is the mean of all the rural values
+        months = PERIOD_MONTHS.get(self.period)
+        for name, key, selection in (('ds_annual_cycle', 'month', None),
+                                     ('ds_daily_cycle', 'hour', months)):
+            group_sums, group_counts = sums, counts
+            if selection is not None:
+                in_period = sums['month'].isin(selection)
+                group_sums, group_counts = sums.sel(group = in_period), counts.sel(group = in_period)
+            group_sums = group_sums.groupby(key).sum()
+            group_counts = group_counts.groupby(key).sum()
+            ds_period_mean = group_sums / group_counts
+            rural_mean = (UrbanIsland.gather_cells(self, group_sums, 'rural').sum('cell') /
+                          UrbanIsland.gather_cells(self, group_counts, 'rural').sum('cell'))
+            ds_anomaly = ds_period_mean - rural_mean
+            ds_anomaly.attrs['units'] = units
+            if self.anomaly == 'rel':
+                ds_anomaly = (ds_anomaly / ds_period_mean) * 100
+                ds_anomaly.attrs['units'] = "%"
+            setattr(self, name, ds_anomaly)
+            setattr(self, f"{name[3:]}_summary", UrbanIsland.summarize_cycle(self, ds_anomaly))
+
+        obs_anomaly = UrbanIsland._obs_spatial_climatology(self)
+        if obs_anomaly is not None:
+            self.obs_spatial_climatology = obs_anomaly
+        self.obs_annual_cycle = UrbanIsland._obs_cycle(self, 'month')
+        self.obs_daily_cycle = UrbanIsland._obs_cycle(self, 'hour')
+
+    def summarize_cycle(self, ds_anomaly, *, percentiles = CYCLE_PERCENTILES):
+        """
+        Computes the urban and vicinity summaries of an annual or daily cycle anomaly.
+
+        Parameters:
+        - ds_anomaly (xarray.DataArray): Cycle anomaly (month or hour, Y, X).
+        - percentiles (list of int): Percentiles of the bands (their complements are also computed).
+
+        Outputs:
+        - xarray.Dataset with the mean ('area', month/hour) and the percentiles
+          ('area', 'percentile', month/hour) over the cells of each area ('urban', 'rural').
+        """
+        spatial_dims = [ds_anomaly.cf['Y'].name, ds_anomaly.cf['X'].name]
+        group = [dim for dim in ds_anomaly.dims if dim not in spatial_dims][0]
+        levels = sorted(set(percentiles) | {100 - percentile for percentile in percentiles})
+        areas = ['urban', 'rural']
+        means, quantiles = [], []
+        for area in areas:
+            cells = UrbanIsland.gather_cells(self, ds_anomaly, area).transpose(group, 'cell').values
+            with warnings.catch_warnings():
+                # All-NaN groups (e.g. no cells of the area)
+                warnings.simplefilter('ignore', RuntimeWarning)
+                means.append(np.nanmean(cells, axis = 1))
+                quantiles.append(np.nanpercentile(cells, levels, axis = 1))
+        return xr.Dataset(
+            {
+                'mean': (('area', group), np.array(means)),
+                'percentiles': (('area', 'percentile', group), np.array(quantiles)),
+            },
+            coords = {'area': areas, 'percentile': levels, group: ds_anomaly[group].values},
+            attrs = ds_anomaly.attrs,
+        )
+
+    def _cycle_plot_summary(self, ds_anomaly, name, percentiles):
+        # Precomputed summary of the cycle, unless the anomaly or the percentiles differ
+        percentiles = percentiles or []
+        summary = getattr(self, f"{name}_summary", None)
+        if (summary is None or ds_anomaly is not getattr(self, f"ds_{name}", None)
+                or not set(percentiles) <= set(summary['percentile'].values)):
+            summary = UrbanIsland.summarize_cycle(self, ds_anomaly, percentiles = percentiles)
+        return summary
+
+    def _plot_cycle_cells(self, ax, ds_anomaly, summary, percentiles, gridcell_series):
+        # Percentile bands and grid cell series (one LineCollection per area)
+        group = [dim for dim in summary['mean'].dims if dim != 'area'][0]
+        x = summary[group].values
+        colors = {'rural': '#8A8D28', 'urban': '#A52A2A'}
+        for area in ['rural', 'urban']:
+            for percentile in percentiles:
+                lower_percentile = summary['percentiles'].sel(area = area, percentile = percentile).values
+                upper_percentile = summary['percentiles'].sel(area = area, percentile = 100-percentile).values
+                ax.fill_between(
+                    x, lower_percentile, upper_percentile,
+                    color=colors[area], alpha=0.1, linewidth=1, linestyle = '--',
+                )
+                # Plot the lower percentile line
+                ax.plot(
+                    x, lower_percentile,
+                    color=colors[area], alpha=0.5, linewidth=1, linestyle='--', label=f'{percentile} to {100-percentile} Percentile')
+                # Plot the upper percentile line
+                ax.plot(
+                    x, upper_percentile,
+                    color=colors[area], alpha=0.5, linewidth=1, linestyle='--')
+            if gridcell_series:
+                cells = UrbanIsland.gather_cells(self, ds_anomaly, area).transpose('cell', group).values
+                segments = np.stack(np.broadcast_arrays(x, cells), axis = -1)
+                ax.add_collection(LineCollection(np.ma.masked_invalid(segments),
+                                                 color=colors[area], linewidth=0.1, alpha = 0.1))
+        ax.autoscale_view()
+
+    def compute_station_timeseries(self):
+        """
+        Extracts the model time series at the observation points.
+
+        Every station of `obs_attr` is mapped once to its nearest grid cell
+        through the spatial index of the model grid, and all the series are
+        gathered from the (dask-backed) dataset with a single indexed read.
+        Against daily observations, sub-daily model data are averaged to daily means.
+
+        Output:
+        - self.model_timeseries: pandas.DataFrame (time, station) aligned with `obs_time`.
+        """
+        index = get_grid_index(self.ds['lon'].values, self.ds['lat'].values)
+        iy, ix = index.query(self.obs_attr['lon'].values, self.obs_attr['lat'].values)
+        codes = self.obs_attr['code'].astype(str).values
+        station_series = self.ds.isel({
+            self.ds.cf['Y'].name: xr.DataArray(iy, dims = 'station'),
+            self.ds.cf['X'].name: xr.DataArray(ix, dims = 'station'),
+        }).compute()
+        model_timeseries = pd.DataFrame(
+            station_series.transpose('time', 'station').values,
+            index = station_series.indexes['time'],
+            columns = codes,
+        )
+        if isinstance(model_timeseries.index, xr.CFTimeIndex):
+            model_timeseries.index = model_timeseries.index.to_datetimeindex(time_unit = 'ns')
+        obs_index = pd.DatetimeIndex(self.obs_time.index)
+        if (obs_index == obs_index.normalize()).all():
+            # Daily observations: model values are matched by date, and sub-daily
+            # model values are averaged to daily means
+            model_timeseries = model_timeseries.groupby(model_timeseries.index.normalize()).mean()
+        self.model_timeseries = model_timeseries.reindex(obs_index)
+
+    def compute_station_metrics(self):
+        """
+        Computes bias, RMSE and correlation of the model against the observations.
+
+        Metrics are computed at once for all the stations and for the urban and
+        vicinity mean series (stations inside and outside the city).
+
+        Output:
+        - self.station_metrics: pandas.DataFrame with the number of paired
+          values, bias, RMSE and correlation of each station ('urban_mean' and
+          'rural_mean' rows for the urban and vicinity means).
+        """
+        if not hasattr(self, 'model_timeseries'):
+            self.compute_station_timeseries()
+        codes = self.obs_attr['code'].astype(str)
+        codes_ins_city = codes[(self.obs_attr['inside_city'] == True).values]
+        codes_out_city = codes[(self.obs_attr['inside_city'] == False).values]
+        obs = self.obs_time[codes.values]
+        model = self.model_timeseries[codes.values]
+        obs = obs.assign(urban_mean = obs[codes_ins_city].mean(axis = 1),
+                         rural_mean = obs[codes_out_city].mean(axis = 1))
+        model = model.assign(urban_mean = model[codes_ins_city].mean(axis = 1),
+                             rural_mean = model[codes_out_city].mean(axis = 1))
+
+        model_values, obs_values = model.values, obs.values
+        paired = ~(np.isnan(model_values) | np.isnan(obs_values))
+        model_values = np.where(paired, model_values, np.nan)
+        obs_values = np.where(paired, obs_values, np.nan)
+        n = paired.sum(axis = 0)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            error = model_values - obs_values
+            model_anomaly = model_values - np.nanmean(model_values, axis = 0)
+            obs_anomaly = obs_values - np.nanmean(obs_values, axis = 0)
+            self.station_metrics = pd.DataFrame({
+                'inside_city': list(self.obs_attr['inside_city']) + [True, False],
+                'n': n,
+                'bias': np.nansum(error, axis = 0) / n,
+                'rmse': np.sqrt(np.nansum(error**2, axis = 0) / n),
+                'corr': np.nansum(model_anomaly * obs_anomaly, axis = 0) / np.sqrt(
+                    np.nansum(model_anomaly**2, axis = 0) * np.nansum(obs_anomaly**2, axis = 0)),
+            }, index = obs.columns)
 
     
     def plot_UI_map(
@@ -294,14 +612,9 @@ class UrbanIsland:
                 self.compute_annual_cycle()
             ds_anomaly = self.ds_annual_cycle
         
-        is_rural = self.urban_vicinity['urmask'] == 0
-        is_urban = self.urban_vicinity['urmask'] == 1
-
-        rural_anomaly = ds_anomaly.where(is_rural)
-        urban_anomaly = ds_anomaly.where(is_urban)
-    
-        urban_mean = urban_anomaly.mean(dim = [ds_anomaly.cf['Y'].name, ds_anomaly.cf['X'].name]).compute()
-        rural_mean = rural_anomaly.mean(dim = [ds_anomaly.cf['Y'].name, ds_anomaly.cf['X'].name]).compute()
+        summary = UrbanIsland._cycle_plot_summary(self, ds_anomaly, 'annual_cycle', percentiles)
+        urban_mean = summary['mean'].sel(area = 'urban')
+        rural_mean = summary['mean'].sel(area = 'rural')
 
         urban_area_legend = False
         not_urban_area_legend = False
@@ -315,34 +628,8 @@ class UrbanIsland:
                                      linewidth = 4, label='Vicinity mean')
                              
         if percentiles:
-            # Fill within percentiles
-            axis = [rural_anomaly.get_axis_num(rural_anomaly.cf['X'].name),
-                    rural_anomaly.get_axis_num(rural_anomaly.cf['Y'].name)]
-            colors = ['#8A8D28', '#A52A2A']
-            for index, anom in enumerate([ rural_anomaly, urban_anomaly]):
-                for percentile in percentiles:
-                    lower_percentile = np.nanpercentile(anom, percentile, axis=axis)
-                    upper_percentile = np.nanpercentile(anom, 100-percentile, axis=axis)
-                    ax.fill_between(
-                        rural_anomaly['month'],
-                        lower_percentile, upper_percentile,
-                        color=colors[index], alpha=0.1, linewidth=1, linestyle = '--',
-                    )
-        
-                    # Plot the lower percentile line
-                    ax.plot(
-                        rural_anomaly['month'], lower_percentile,
-                        color=colors[index], alpha=0.5, linewidth=1, linestyle='--',  label=f'{percentile} to {100-percentile} Percentile')
-                    # Plot the upper percentile line
-                    ax.plot(
-                        rural_anomaly['month'], upper_percentile,
-                        color=colors[index], alpha=0.5, linewidth=1, linestyle='--')
-                if gridcell_series:
-                    for i, j in product(anom.cf['X'].values, anom.cf['Y'].values):
-                        anom_val = anom.sel({ds_anomaly.cf['X'].name:i,
-                                             ds_anomaly.cf['Y'].name:j})
-                        if not np.isnan(anom_val[0]):
-                            anom_val.plot(ax=ax, color=colors[index], linewidth=0.1, alpha = 0.1)
+            # Fill within percentiles and draw the grid cell series
+            UrbanIsland._plot_cycle_cells(self, ax, ds_anomaly, summary, percentiles, gridcell_series)
                              
         #Plot the observation if requested
         if not self.obs_attr.empty:
@@ -417,14 +704,9 @@ class UrbanIsland:
                 self.compute_daily_cycle()
             ds_anomaly = self.ds_daily_cycle
         
-        is_rural = self.urban_vicinity['urmask'] == 0
-        is_urban = self.urban_vicinity['urmask'] == 1
-
-        rural_anomaly = ds_anomaly.where(is_rural)
-        urban_anomaly = ds_anomaly.where(is_urban)
-    
-        urban_mean = urban_anomaly.mean(dim = [ds_anomaly.cf['Y'].name, ds_anomaly.cf['X'].name]).compute()
-        rural_mean = rural_anomaly.mean(dim = [ds_anomaly.cf['Y'].name, ds_anomaly.cf['X'].name]).compute()
+        summary = UrbanIsland._cycle_plot_summary(self, ds_anomaly, 'daily_cycle', percentiles)
+        urban_mean = summary['mean'].sel(area = 'urban')
+        rural_mean = summary['mean'].sel(area = 'rural')
 
         urban_area_legend = False
         not_urban_area_legend = False
@@ -440,33 +722,8 @@ class UrbanIsland:
         
         # Plot individual data squares for urban and rural areas if requested
         if percentiles:
-            # Fill within percentiles
-            axis = [rural_anomaly.get_axis_num(rural_anomaly.cf['X'].name),
-                    rural_anomaly.get_axis_num(rural_anomaly.cf['Y'].name)]
-            colors = ['#8A8D28', '#A52A2A']
-            for index, anom in enumerate([ rural_anomaly, urban_anomaly]):
-                for percentile in percentiles:
-                    lower_percentile = np.nanpercentile(anom, percentile, axis=axis)
-                    upper_percentile = np.nanpercentile(anom, 100-percentile, axis=axis)
-                    ax.fill_between(
-                        rural_anomaly['hour'],
-                        lower_percentile, upper_percentile,
-                        color=colors[index], alpha=0.1, linewidth=1, linestyle = '--',
-                    )
-        
-                    # Plot the lower percentile line
-                    ax.plot(
-                        rural_anomaly['hour'], lower_percentile,
-                        color=colors[index], alpha=0.5, linewidth=1, linestyle='--', label=f'{percentile} to {100-percentile} Percentile')
-                    # Plot the upper percentile line
-                    ax.plot(
-                        rural_anomaly['hour'], upper_percentile,
-                        color=colors[index], alpha=0.5, linewidth=1, linestyle='--')
-                for i, j in product(anom.cf['X'].values, anom.cf['Y'].values):
-                    anom_val = anom.sel({ds_anomaly.cf['X'].name:i,
-                                         ds_anomaly.cf['Y'].name:j})
-                    if not np.isnan(anom_val[0]):
-                        anom_val.plot(ax=ax, color=colors[index], linewidth=0.1, alpha = 0.1)
+            # Fill within percentiles and draw the grid cell series
+            UrbanIsland._plot_cycle_cells(self, ax, ds_anomaly, summary, percentiles, gridcell_series)
 
         # Plot observations if requested
         if not self.obs_attr.empty:
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import re
+import pandas as pd
+
+from urclimask.utils import model_from_rcm
+
+# CORDEX DRS directory facets below the root (e.g. .../cordex/output)
+DRS_FACETS = ["domain", "institute", "driving_model", "experiment", "ensemble",
+              "rcm", "rcm_version", "frequency", "variable", "version"]
+
+CATALOG_COLUMNS = ["path", "dir"] + DRS_FACETS + ["model", "start", "end"]
+
+TIME_RANGE = re.compile(r'^(\d+)-(\d+)$')
+
+
+def parse_drs_path(path, root):
+    """
+    Parse the CORDEX DRS facets of a file path.
+
+    Parameters:
+    path (str): Path of the file.
+    root (str): Root of the DRS tree (the directory containing the domains).
+
+    Returns:
+    dict: Facets of the file (None if the path does not follow the DRS).
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    if len(parts) != len(DRS_FACETS) + 1 or not parts[-1].endswith('.nc'):
+        return None
+    facets = dict(zip(DRS_FACETS, parts[:-1]))
+    facets['model'] = model_from_rcm(facets['domain'], f"{facets['institute']}_{facets['rcm']}")
+    time_range = TIME_RANGE.match(os.path.splitext(parts[-1])[0].split('_')[-1])
+    facets['start'], facets['end'] = time_range.groups() if time_range else (None, None)
+    return facets
+
+
+class FileCatalog:
+    def __init__(self, root : str, catalog_file : str | None = None):
+        """
+        Persistent catalog of the files of a CORDEX DRS tree.
+
+        The tree is scanned once and the DRS facets of every file are stored
+        in a Parquet table. Later refreshes only list the directories whose
+        modification time changed, so they cost one stat per directory.
+
+        Parameters
+        ----------
+        root : str
+            Root of the DRS tree (e.g. '/lustre/.../ESGF/REPLICA/DATA/cordex/output/').
+        catalog_file : str
+            Parquet file of the catalog. By default, a file in ~/.cache/urclimask
+            named after the root.
+        """
+        self.root = os.path.abspath(root)
+        if catalog_file is None:
+            digest = hashlib.sha1(self.root.encode()).hexdigest()[:12]
+            catalog_file = os.path.join(os.path.expanduser('~/.cache/urclimask'),
+                                        f'file-catalog_{digest}.parquet')
+        self.catalog_file = catalog_file
+        self._dirs_file = f'{os.path.splitext(catalog_file)[0]}.dirs.json'
+        if os.path.exists(catalog_file) and os.path.exists(self._dirs_file):
+            self.df = pd.read_parquet(catalog_file)
+            with open(self._dirs_file) as f:
+                self._dirs = json.load(f)
+        else:
+            self.df = pd.DataFrame(columns=CATALOG_COLUMNS)
+            self._dirs = {}
+
+    def refresh(self) -> 'FileCatalog':
+        """
+        Update the catalog with the changes in the tree since the last scan.
+
+        Returns
+        -------
+        FileCatalog
+            The catalog itself.
+        """
+        files = {dirpath: group for dirpath, group in self.df.groupby('dir')}
+        dirs = {}
+        records = []
+        pending = [self.root]
+        while pending:
+            dirpath = pending.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            known = self._dirs.get(dirpath)
+            if known is not None and known['mtime'] == mtime:
+                # Unchanged directory: reuse its entries, only check its subdirectories
+                subdirs = known['subdirs']
+                if dirpath in files:
+                    records.append(files[dirpath])
+            else:
+                subdirs, new_files = [], []
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.name.endswith('.nc'):
+                            facets = parse_drs_path(entry.path, self.root)
+                            if facets is not None:
+                                new_files.append({'path': entry.path, 'dir': dirpath, **facets})
+                if new_files:
+                    records.append(pd.DataFrame(new_files, columns=CATALOG_COLUMNS))
+            dirs[dirpath] = {'mtime': mtime, 'subdirs': subdirs}
+            pending += [os.path.join(dirpath, subdir) for subdir in subdirs]
+
+        records = [record for record in records if len(record)]
+        self.df = (pd.concat(records, ignore_index=True) if records
+                   else pd.DataFrame(columns=CATALOG_COLUMNS))
+        self.df = self.df.sort_values('path', ignore_index=True)
+        self._dirs = dirs
+        FileCatalog._save(self)
+        return self
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.catalog_file)), exist_ok=True)
+        tmp_file = f'{self.catalog_file}.{os.getpid()}.tmp'
+        self.df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, self.catalog_file)
+        tmp_file = f'{self._dirs_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._dirs, f)
+        os.replace(tmp_file, self._dirs_file)
+
+    def query(self, **facets) -> pd.DataFrame:
+        """
+        Catalog entries matching the given facets.
+
+        Parameters
+        ----------
+        **facets
+            Values of the DRS facets (domain, institute, driving_model,
+            experiment, ensemble, rcm, rcm_version, frequency, variable,
+            version). `model` matches the RCM_DICT key (e.g. 'REMO') or the
+            '<institute>_<rcm>' label. Lists select several values.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Matching entries sorted by path.
+        """
+        selection = pd.Series(True, index=self.df.index)
+        for facet, value in facets.items():
+            if facet not in CATALOG_COLUMNS:
+                raise ValueError(f"Unknown facet '{facet}'. Valid facets: {DRS_FACETS + ['model']}")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            match = self.df[facet].isin(values)
+            if facet == 'model':
+                match |= (self.df['institute'] + '_' + self.df['rcm']).isin(values)
+            selection &= match
+        return self.df[selection]
+
+    def latest(self, **facets) -> pd.DataFrame:
+        """
+        Catalog entries matching the given facets (see `query`), keeping only
+        the latest `version` of every dataset (entries sharing all the other
+        DRS facets).
+
+        Returns
+        -------
+        pandas.DataFrame
+            Matching entries of the latest versions sorted by path.
+        """
+        df = FileCatalog.query(self, **facets)
+        if df.empty:
+            return df
+        dataset = [facet for facet in DRS_FACETS if facet != 'version']
+        return df[df['version'] == df.groupby(dataset)['version'].transform('max')]
+
+    def files(self, **facets) -> list:
+        """
+        Sorted list of the files matching the given facets (see `query`).
+        """
+        return FileCatalog.query(self, **facets)['path'].tolist()
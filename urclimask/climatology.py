@@ -0,0 +1,344 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from urclimask.utils import kelvin2degC
+
+# (month, hour) groups of the accumulator state. Only the groups present in
+# the data are stored, numbered (month - 1) * 24 + hour
+MONTHS = np.arange(1, 13)
+HOURS = np.arange(24)
+
+
+def _group_coords(codes):
+    """
+    Coordinates of the state groups with the given numbers.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    return {'group': codes, 'month': ('group', codes // HOURS.size + 1), 'hour': ('group', codes % HOURS.size)}
+
+
+def _block_moments(values, group):
+    """
+    Count, sum and sum of squared deviations (M2) of the valid values of a block per group.
+
+    Parameters:
+    values (numpy.ndarray): Block with time as the first dimension.
+    group (numpy.ndarray): Group number of each time step.
+
+    Returns:
+    tuple: Groups present in the block and the (count, sum, m2) arrays of shape (groups, ...).
+    """
+    if values.shape[0] == 0:
+        empty = np.zeros((0,) + values.shape[1:])
+        return np.zeros(0, dtype=np.int64), (empty, empty, empty)
+    order = np.argsort(group, kind='stable')
+    present, starts = np.unique(group[order], return_index=True)
+    values = values[order]
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid, starts, axis=0).astype(float)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        group_mean = sums / count
+        # Two-pass M2 within the block: deviations from the group mean of the block
+        steps = np.diff(np.append(starts, group.size))
+        deviation = np.where(valid, values - np.repeat(group_mean, steps, axis=0), 0)
+    m2 = np.add.reduceat(deviation**2, starts, axis=0)
+    return present, (count, sums, m2)
+
+
+def _merge_moments(a, b):
+    """
+    Merge two (count, sum, m2) states (Chan et al. parallel update of Welford's algorithm).
+    """
+    count_a, sum_a, m2_a = a
+    count_b, sum_b, m2_b = b
+    count = count_a + count_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = sum_b / count_b - sum_a / count_a
+        correction = delta**2 * count_a * count_b / count
+    m2 = m2_a + m2_b + np.where((count_a > 0) & (count_b > 0), correction, 0)
+    return count, sum_a + sum_b, m2
+
+
+class ClimatologyAccumulator:
+    def __init__(self, state : xr.Dataset | None = None):
+        """
+        Online accumulator of the spatial, monthly and hourly climatologies.
+
+        The state holds, for every grid cell (or station) and (month, hour)
+        group present in the data, the count, sum and sum of squared deviations
+        (Welford's M2) of the valid values. Data are ingested one file or one
+        year at a time and one time chunk at a time, so extending a climatology
+        costs only the I/O of the new data and the memory of a single chunk.
+        States from parallel workers are combined with `merge`.
+
+        Parameters
+        ----------
+        state : xarray.Dataset
+            Accumulator state (e.g. from `ClimatologyAccumulator.load`). Empty if None.
+        """
+        self.state = state
+
+    @classmethod
+    def load(cls, path : str) -> 'ClimatologyAccumulator':
+        """
+        Accumulator with the state stored in a NetCDF file.
+        """
+        return cls(xr.load_dataset(path))
+
+    def save(self, path : str):
+        """
+        Store the state in a (compressed) NetCDF file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        encoding = {name: {'zlib': True, 'complevel': 4} for name in ('count', 'sum', 'm2')}
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        self.state.to_netcdf(tmp_file, encoding=encoding)
+        os.replace(tmp_file, path)
+
+    @property
+    def sources(self) -> list:
+        """Sources (e.g. files) already ingested."""
+        if self.state is None:
+            return []
+        return json.loads(self.state.attrs.get('sources', '[]'))
+
+    def _empty_state(self, da):
+        template = da.isel(time=0, drop=True)
+        state = xr.Dataset(
+            {name: (('group',) + template.dims, np.zeros((0,) + template.shape))
+             for name in ('count', 'sum', 'm2')},
+            coords=dict(template.coords, **_group_coords([])),
+        )
+        state.attrs = {
+            'variable': str(da.name),
+            'units': da.attrs.get('units', 'unknown'),
+            'sources': '[]',
+        }
+        return state
+
+    def _with_groups(self, codes):
+        """
+        State extended with (empty) groups, so that it holds all the `codes`.
+        """
+        codes = np.union1d(self.state['group'].values, codes)
+        if codes.size == self.state.sizes['group']:
+            return self.state
+        return self.state.reindex(group=codes, fill_value=0.0).assign_coords(_group_coords(codes))
+
+    def update(self, da, *, source : str | None = None, time_chunk : int = 365) -> bool:
+        """
+        Ingest new data into the accumulator.
+
+        Parameters
+        ----------
+        da : xarray.DataArray or pandas.DataFrame
+            Data with a 'time' dimension on the grid of the state (or a
+            (time, station) DataFrame of observations).
+        source : str
+            Name of the data (e.g. the file path). Sources already ingested are skipped.
+        time_chunk : int
+            Number of time steps read at once when `da` is not dask-backed.
+            Dask-backed data are read chunk by chunk along time.
+
+        Returns
+        -------
+        bool
+            False if the source had already been ingested.
+        """
+        if isinstance(da, pd.DataFrame):
+            da = xr.DataArray(da.values, dims=('time', 'station'),
+                              coords={'time': da.index, 'station': da.columns.astype(str)})
+        if source is not None and source in self.sources:
+            return False
+        da = da.transpose('time', ...)
+        if self.state is None:
+            self.state = ClimatologyAccumulator._empty_state(self, da)
+        elif self.state['count'].shape[1:] != da.shape[1:]:
+            raise ValueError(f"Data shape {da.shape[1:]} does not match the accumulator grid "
+                             f"{self.state['count'].shape[1:]}")
+
+        group = ((da['time'].dt.month - 1) * HOURS.size + da['time'].dt.hour).values
+        self.state = ClimatologyAccumulator._with_groups(self, np.unique(group))
+        position = np.searchsorted(self.state['group'].values, group)
+        data = da.data
+        if hasattr(data, 'chunks'):
+            bounds = np.cumsum((0,) + data.chunks[0])
+        else:
+            bounds = np.append(np.arange(0, da.shape[0], time_chunk), da.shape[0])
+        moments = [np.array(self.state[name].values) for name in ('count', 'sum', 'm2')]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            values = np.asarray(da[start:end].values, dtype=float)
+            # Only the groups present in the chunk are updated
+            present, block = _block_moments(values, position[start:end])
+            merged = _merge_moments([moment[present] for moment in moments], block)
+            for moment, values in zip(moments, merged):
+                moment[present] = values
+        for name, values in zip(('count', 'sum', 'm2'), moments):
+            self.state[name].values = values
+
+        time = da.indexes['time']
+        attrs = self.state.attrs
+        attrs['time_start'] = min(filter(None, [attrs.get('time_start'), time[0].isoformat()]))
+        attrs['time_end'] = max(filter(None, [attrs.get('time_end'), time[-1].isoformat()]))
+        if source is not None:
+            attrs['sources'] = json.dumps(self.sources + [source])
+        return True
+
+    def update_files(
+        self,
+        files : list,
+        variable : str,
+        *,
+        urban = None,
+        res : int | None = None,
+        index_cache_dir : str | None = None,
+        preprocess = None,
+        time_chunk : int = 365,
+        **kwargs,
+    ) -> int:
+        """
+        Ingest the files not yet in the accumulator, one at a time.
+
+        Every file is cropped and converted as in `UrbanVicinity.open_city_dataset`
+        if `urban` is given, so the state matches the grid and units of the
+        `UrbanIsland` dataset. Otherwise, only Kelvin is converted to Celsius.
+
+        Parameters
+        ----------
+        files : list
+            Paths of the NetCDF files.
+        variable : str
+            Variable to accumulate.
+        urban : urclimask.urban_areas.UrbanVicinity
+            Read only the window around this city.
+        res : int
+            Domain resolution (e.g. 11/22), for the city window.
+        index_cache_dir : str
+            Directory to store the spatial index of the grid on disk (optional).
+        preprocess : callable
+            Function applied to each opened dataset instead (e.g. a custom crop).
+        time_chunk : int
+            Number of time steps read at once.
+        **kwargs
+            Passed to xarray.open_dataset.
+
+        Returns
+        -------
+        int
+            Number of ingested files.
+        """
+        files = [path for path in files if str(path) not in self.sources]
+        if preprocess is None and urban is not None and files:
+            preprocess = urban.city_preprocess(files[0], variable, res = res,
+                                               index_cache_dir = index_cache_dir)
+        elif preprocess is None:
+            preprocess = lambda ds: kelvin2degC(ds, variable)
+        ingested = 0
+        for path in files:
+            with xr.open_dataset(path, chunks={'time': time_chunk}, **kwargs) as ds:
+                ingested += ClimatologyAccumulator.update(self, preprocess(ds)[variable], source=str(path))
+        return ingested
+
+    def merge(self, other : 'ClimatologyAccumulator') -> 'ClimatologyAccumulator':
+        """
+        Add the state of another accumulator (e.g. from a parallel worker) on the same grid.
+
+        Returns
+        -------
+        ClimatologyAccumulator
+            The accumulator itself.
+        """
+        if other.state is None:
+            return self
+        if self.state is None:
+            self.state = other.state.copy(deep=True)
+            return self
+        if self.state['count'].shape[1:] != other.state['count'].shape[1:]:
+            raise ValueError("Accumulators on different grids cannot be merged")
+        overlap = set(self.sources) & set(other.sources)
+        if overlap:
+            raise ValueError(f"Sources ingested by both accumulators: {sorted(overlap)}")
+        self.state = ClimatologyAccumulator._with_groups(self, other.state['group'].values)
+        other_state = other.state.reindex(group=self.state['group'].values, fill_value=0.0)
+        moments = _merge_moments(
+            *[[state[name].values for name in ('count', 'sum', 'm2')]
+              for state in (self.state, other_state)]
+        )
+        for name, values in zip(('count', 'sum', 'm2'), moments):
+            self.state[name].values = values
+        attrs = self.state.attrs
+        for key, select in (('time_start', min), ('time_end', max)):
+            values = [state.attrs[key] for state in (self.state, other.state) if key in state.attrs]
+            if values:
+                attrs[key] = select(values)
+        attrs['sources'] = json.dumps(self.sources + other.sources)
+        return self
+
+    def _moments(self, by, months):
+        state = self.state
+        if months is not None:
+            state = state.isel(group=state['month'].isin(months).values)
+        if by is None:
+            state = state.assign_coords(period=('group', np.zeros(state.sizes['group'], dtype=int)))
+        key = by or 'period'
+        grouped = state[['count', 'sum', 'm2']].groupby(key).sum()
+        count = grouped['count']
+        mean = grouped['sum'] / count
+        # Between-group contribution to M2
+        deviation = (state['sum'] / state['count']).groupby(key) - mean
+        between = (state['count'] * deviation**2).fillna(0).groupby(key).sum()
+        m2 = grouped['m2'] + between
+        if by is None:
+            count, mean, m2 = [values.isel(period=0, drop=True) for values in (count, mean, m2)]
+        else:
+            # Only the months or hours present in the data
+            present = (count.sum([dim for dim in count.dims if dim != by]) > 0).values
+            count, mean, m2 = [values.isel({by: present}) for values in (count, mean, m2)]
+        return count, mean, m2
+
+    def mean(self, by : str | None = None, *, months : list | None = None) -> xr.DataArray:
+        """
+        Climatology from the accumulated data.
+
+        Parameters
+        ----------
+        by : str
+            None for the climatology of the whole period, 'month' for the
+            annual cycle or 'hour' for the daily cycle.
+        months : list
+            Restrict to these months (e.g. [6, 7, 8]).
+
+        Returns
+        -------
+        xarray.DataArray
+            Mean of each grid cell (and month or hour).
+        """
+        count, mean, _ = ClimatologyAccumulator._moments(self, by, months)
+        mean = mean.where(count > 0).rename(self.state.attrs['variable'])
+        mean.attrs['units'] = self.state.attrs['units']
+        return mean
+
+    def variance(self, by : str | None = None, *, months : list | None = None) -> xr.DataArray:
+        """
+        Sample variance of the accumulated data (see `mean` for the parameters).
+        """
+        count, _, m2 = ClimatologyAccumulator._moments(self, by, months)
+        return (m2 / (count - 1)).where(count > 1).rename(self.state.attrs['variable'])
+
+    def group_sums(self) -> tuple:
+        """
+        Sums and counts per (month, hour) group present in the data, in the
+        format of `urclimask.UHI_analysis.month_hour_sums` (used by
+        `UrbanIsland.compute_all`).
+        """
+        state = self.state
+        present = (state['count'].sum([dim for dim in state['count'].dims if dim != 'group']) > 0).values
+        state = state.isel(group=present).drop_indexes('group').drop_vars('group')
+        name = state.attrs['variable']
+        sums = state['sum'].rename(name).assign_attrs(units=state.attrs['units'])
+        counts = state['count'].rename(name).assign_attrs(units=state.attrs['units'])
+        return sums, counts
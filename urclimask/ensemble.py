@@ -0,0 +1,348 @@
+import argparse
+import cf_xarray  # registers the .cf accessor used by UrbanIsland
+import json
+import os
+import resource
+import time
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dask.utils import parse_bytes
+
+from urclimask.catalog import FileCatalog
+from urclimask.UHI_analysis import UrbanIsland
+from urclimask.urban_areas import city_hyperparameters, UrbanVicinity
+from urclimask.utils import RCM_DICT
+
+# Columns of the ensemble results table (one row per city entry and variable)
+ENSEMBLE_COLUMNS = ["city", "name", "domain", "model", "urban_var", "variable",
+                    "driving_model", "ensemble", "rcm_version", "version", "status",
+                    "uhi_mean", "uhi_max", "annual_amplitude", "daily_amplitude",
+                    "urban_cells", "rural_cells", "seconds", "error"]
+
+ENSEMBLE_METRICS = ["uhi_mean", "uhi_max", "annual_amplitude", "daily_amplitude"]
+
+# DRS facets identifying the simulation (run) of the model data
+RUN_FACETS = ["driving_model", "ensemble", "rcm_version"]
+
+
+def ensemble_jobs(cities, variables, *, domains=None, models=None):
+    """
+    Jobs of the ensemble: one per entry of the cities configuration, with its variables.
+
+    Parameters:
+    cities (dict): Cities configuration (e.g. selected_cities.yaml).
+    variables (list): Variables to analyse (e.g. ['tasmin', 'tasmax']).
+    domains (list): Restrict to these domains (all by default).
+    models (list): Restrict to these models (RCM_DICT keys, all by default).
+
+    Returns:
+    pandas.DataFrame: Jobs with the city entry, name, domain, model, urban_var and variable.
+    """
+    jobs = [
+        {
+            'city': city,
+            'name': cities[city]['name'],
+            'domain': cities[city]['domain'],
+            'model': city.split('_')[1],
+            'urban_var': city.split('_')[2],
+            'variable': variable,
+        }
+        for city in cities if city != 'DEFAULT'
+        for variable in variables
+    ]
+    jobs = pd.DataFrame(jobs, columns=['city', 'name', 'domain', 'model', 'urban_var', 'variable'])
+    # Only the models of RCM_DICT
+    jobs = jobs[[model in RCM_DICT.get(domain, {}) for domain, model in zip(jobs['domain'], jobs['model'])]]
+    if domains is not None:
+        jobs = jobs[jobs['domain'].isin(domains)]
+    if models is not None:
+        jobs = jobs[jobs['model'].isin(models)]
+    return jobs.reset_index(drop=True)
+
+
+def read_manifest(manifest_file):
+    """
+    Latest record of each (city entry, variable) in the manifest of an ensemble run.
+
+    Parameters:
+    manifest_file (str): JSON-lines manifest.
+
+    Returns:
+    pandas.DataFrame: Records with the ENSEMBLE_COLUMNS.
+    """
+    records = []
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    records = pd.DataFrame(records, columns=ENSEMBLE_COLUMNS)
+    return records.drop_duplicates(['city', 'variable'], keep='last').reset_index(drop=True)
+
+
+def ensemble_dataset(results):
+    """
+    Ensemble results as a Dataset with city, domain, model, urban_var and variable dimensions.
+
+    Parameters:
+    results (pandas.DataFrame): Results table (from `run_ensemble` or `read_manifest`).
+
+    Returns:
+    xarray.Dataset: UHI metrics of the completed jobs.
+    """
+    results = results[results['status'] == 'ok']
+    results = results.rename(columns={'city': 'entry', 'name': 'city'})
+    return (results.set_index(['city', 'domain', 'model', 'urban_var', 'variable'])[ENSEMBLE_METRICS]
+            .astype(float).to_xarray())
+
+
+def _init_ensemble_worker(memory_limit, dask_threads):
+    """
+    Limit the memory (data segment) of a worker process and its dask threads.
+    """
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+    if dask_threads == 1:
+        # No thread pool: allocation failures are raised in the worker itself
+        dask.config.set(scheduler='synchronous')
+    else:
+        dask.config.set(scheduler='threads', num_workers=dask_threads)
+
+
+def _cycle_amplitude(summary):
+    # Amplitude of the urban mean anomaly cycle (NaN with less than two months/hours)
+    urban = summary['mean'].sel(area='urban').values
+    if np.isfinite(urban).sum() < 2:
+        return np.nan
+    return float(np.nanmax(urban) - np.nanmin(urban))
+
+
+def _select_run(entries, variable):
+    """
+    Files of the single run (driving_model, ensemble, rcm_version) among the
+    catalog entries of a variable, in their latest version.
+
+    Parameters:
+    entries (pandas.DataFrame): Catalog entries of the variable (from `FileCatalog.latest`).
+    variable (str): Variable name (for the error messages).
+
+    Returns:
+    tuple: Sorted list of files and dict with the run facets and version.
+    """
+    if entries.empty:
+        raise FileNotFoundError(f"No {variable} files found")
+    runs = entries.groupby(RUN_FACETS)['version'].first()
+    if len(runs) > 1:
+        runs = ', '.join('/'.join(run) for run in runs.index)
+        raise ValueError(f"Several {variable} runs found ({runs}); "
+                         "restrict the driving model, ensemble or rcm_version")
+    run = dict(zip(RUN_FACETS, runs.index[0]), version=runs.iloc[0])
+    return sorted(entries['path']), run
+
+
+def _run_ensemble_city(urban, mask_path, files, variables, idate, fdate, anomaly):
+    """
+    UHI metrics of one city entry for several variables (ensemble worker).
+
+    The mask (and the spatial index of the grid) are shared by all the variables.
+    `files` holds the catalog entries of every variable, from which a single
+    run is selected.
+    """
+    records = []
+    urmask = xr.load_dataset(mask_path)
+    res = int(urban.domain.split('-')[1])
+    for variable in variables:
+        start = time.perf_counter()
+        record = {'variable': variable, 'status': 'error'}
+        try:
+            paths, run = _select_run(files[variable], variable)
+            record.update(run)
+            ds = urban.open_city_dataset(paths, variable, res=res)
+            if ds.indexes['time'].duplicated().any():
+                # e.g. overlapping files of a run
+                raise ValueError(f"Duplicated time stamps in the {variable} files")
+            ds = ds.sel(time=slice(idate, fdate))
+            uhi = UrbanIsland(ds=ds[variable], urban_vicinity=urmask, rcm=RCM_DICT[urban.domain][urban.model],
+                              anomaly=anomaly)
+            uhi.compute_all()
+            urban_anomaly = uhi.gather_cells(uhi.ds_spatial_climatology, 'urban').values
+            record.update(
+                status='ok',
+                uhi_mean=float(np.nanmean(urban_anomaly)),
+                uhi_max=float(np.nanmax(urban_anomaly)),
+                annual_amplitude=_cycle_amplitude(uhi.annual_cycle_summary),
+                daily_amplitude=_cycle_amplitude(uhi.daily_cycle_summary),
+                urban_cells=int(uhi.cell_index['urban'].size),
+                rural_cells=int(uhi.cell_index['rural'].size),
+            )
+        except Exception as e:
+            record['error'] = repr(e)
+        record['seconds'] = time.perf_counter() - start
+        records.append(record)
+    return records
+
+
+def run_ensemble(
+    cities,
+    variables,
+    *,
+    catalog,
+    mask_dir : str,
+    output_dir : str = '.',
+    domains : list | None = None,
+    models : list | None = None,
+    experiment : str = 'evaluation',
+    frequency : str = 'day',
+    driving_model : str | None = None,
+    idate : str | None = None,
+    fdate : str | None = None,
+    anomaly : str = 'abs',
+    max_workers : int | None = None,
+    memory_limit : int | str | None = None,
+    dask_threads : int = 1,
+    **facets,
+) -> pd.DataFrame:
+    """
+    Run the UHI analysis for every city entry, model and variable of the ensemble.
+
+    Jobs are grouped by city entry, so each mask and crop window is reused for
+    all the variables, and run in a process pool with a memory limit per
+    worker. Every finished job is appended to a manifest ('manifest.jsonl'
+    in `output_dir`) and jobs already completed are skipped, so an
+    interrupted run resumes where it stopped.
+
+    The files of every variable come from the latest version of a single run
+    (driving_model, ensemble, rcm_version) of the catalog; a job matching
+    several runs fails, so `driving_model` and `facets` must select one.
+
+    Parameters:
+    cities (dict or str): Cities configuration (or path to the YAML file, e.g. selected_cities.yaml).
+    variables (list): Variables to analyse (e.g. ['tasmin', 'tasmax']).
+    catalog (FileCatalog or str): Catalog (or root) of the CORDEX DRS tree.
+    mask_dir (str): Directory with the urmask files written by `UrbanVicinity.batch`.
+    output_dir (str): Directory for the manifest and the results table ('results.csv').
+    domains (list): Restrict to these domains (all by default).
+    models (list): Restrict to these models (RCM_DICT keys, all by default).
+    experiment (str): Experiment of the model data.
+    frequency (str): Frequency of the model data.
+    driving_model (str): Driving model of the model data (any by default).
+    idate (str): Start date of the analysed period (e.g. '1979-01-01').
+    fdate (str): End date of the analysed period (e.g. '2014-12-31').
+    anomaly (str): Type of anomaly; either 'abs' or 'rel'.
+    max_workers (int): Number of processes (0 runs the jobs serially in this process).
+    memory_limit (int or str): Memory limit per worker (e.g. '8GB'), as the data segment limit of the process.
+    dask_threads (int): Dask threads per worker.
+    **facets: Other DRS facets of the model data (e.g. ensemble='r1i1p1', rcm_version='v1').
+
+    Returns:
+    pandas.DataFrame: Results table with one row per city entry and variable.
+    """
+    if isinstance(cities, str):
+        with open(cities) as f:
+            cities = yaml.safe_load(f)
+    if isinstance(catalog, str):
+        catalog = FileCatalog(catalog).refresh()
+    if isinstance(memory_limit, str):
+        memory_limit = parse_bytes(memory_limit)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, 'manifest.jsonl')
+
+    jobs = ensemble_jobs(cities, variables, domains=domains, models=models)
+    done = read_manifest(manifest_file)
+    done = set(zip(*done.loc[done['status'] == 'ok', ['city', 'variable']].values.T))
+    pending = jobs[[(city, variable) not in done for city, variable in zip(jobs['city'], jobs['variable'])]]
+    print(f"{len(jobs)} jobs: {len(jobs) - len(pending)} already completed, {len(pending)} to run")
+
+    facets = {**facets, 'experiment': experiment, 'frequency': frequency}
+    if driving_model is not None:
+        facets['driving_model'] = driving_model
+    tasks = {}
+    for city, city_jobs in pending.groupby('city', sort=False):
+        job = city_jobs.iloc[0]
+        urban = UrbanVicinity(**city_hyperparameters(cities, city))
+        mask_path = os.path.join(
+            mask_dir, f"urmask-{job['urban_var']}_{job['name']}-{job['domain']}_{RCM_DICT[job['domain']][job['model']]}_fx.nc"
+        )
+        files = {variable: catalog.latest(domain=job['domain'], model=job['model'], variable=variable, **facets)
+                 for variable in city_jobs['variable']}
+        tasks[city] = (urban, mask_path, files, list(city_jobs['variable']), idate, fdate, anomaly)
+
+    def collect(city, records):
+        job = pending[pending['city'] == city].iloc[0]
+        with open(manifest_file, 'a') as f:
+            for record in records:
+                record = {**job.drop('variable').to_dict(), **record}
+                f.write(json.dumps(record, default=float) + '\n')
+
+    def failed(city, error):
+        return [{'variable': variable, 'status': 'error', 'error': repr(error)}
+                for variable in tasks[city][3]]
+
+    for city, task in list(tasks.items()):
+        if not os.path.exists(task[1]):
+            collect(city, failed(city, FileNotFoundError(f"Mask not found: {task[1]}")))
+            del tasks[city]
+
+    if max_workers == 0:
+        for city, task in tasks.items():
+            collect(city, _run_ensemble_city(*task))
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_ensemble_worker,
+                                 initargs=(memory_limit, dask_threads)) as executor:
+            futures = {executor.submit(_run_ensemble_city, *task): city for city, task in tasks.items()}
+            for future in as_completed(futures):
+                city = futures[future]
+                try:
+                    collect(city, future.result())
+                except Exception as e:
+                    # e.g. a worker killed for exceeding the memory limit
+                    collect(city, failed(city, e))
+
+    results = read_manifest(manifest_file)
+    results = results.merge(jobs[['city', 'variable']], on=['city', 'variable'])
+    results.to_csv(os.path.join(output_dir, 'results.csv'), index=False)
+    n_failed = (results['status'] != 'ok').sum()
+    print(f"{len(results) - n_failed} jobs completed, {n_failed} failed")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run the UHI analysis for all the cities and models.')
+    parser.add_argument('cities', help = 'Cities configuration (e.g. selected_cities.yaml).')
+    parser.add_argument('--root', required = True, help = 'Root of the CORDEX DRS tree.')
+    parser.add_argument('--mask-dir', required = True, help = 'Directory of the urmask files.')
+    parser.add_argument('--output-dir', default = 'results/ensemble', help = 'Directory of the manifest and results.')
+    parser.add_argument('--variables', nargs = '+', default = ['tasmin', 'tasmax'], help = 'Variables to analyse.')
+    parser.add_argument('--domains', nargs = '+', default = None, help = 'Domains to analyse (all by default).')
+    parser.add_argument('--models', nargs = '+', default = None, help = 'Models to analyse (all by default).')
+    parser.add_argument('--experiment', default = 'evaluation', help = 'Experiment of the model data.')
+    parser.add_argument('--driving-model', default = None, help = 'Driving model of the model data (any by default).')
+    parser.add_argument('--ensemble', default = None, help = 'Ensemble member of the model data (any by default).')
+    parser.add_argument('--rcm-version', default = None, help = 'RCM version of the model data (any by default).')
+    parser.add_argument('--idate', default = None, help = 'Start date of the period (e.g. 1979-01-01).')
+    parser.add_argument('--fdate', default = None, help = 'End date of the period (e.g. 2014-12-31).')
+    parser.add_argument('--anomaly', default = 'abs', choices = ['abs', 'rel'], help = 'Type of anomaly.')
+    parser.add_argument('--max-workers', type = int, default = None, help = 'Number of worker processes.')
+    parser.add_argument('--memory-limit', default = None, help = 'Memory limit per worker (e.g. 8GB).')
+    parser.add_argument('--dask-threads', type = int, default = 1, help = 'Dask threads per worker.')
+    args = parser.parse_args()
+    run_ensemble(
+        args.cities, args.variables,
+        catalog = args.root,
+        mask_dir = args.mask_dir,
+        output_dir = args.output_dir,
+        domains = args.domains,
+        models = args.models,
+        experiment = args.experiment,
+        driving_model = args.driving_model,
+        idate = args.idate,
+        fdate = args.fdate,
+        anomaly = args.anomaly,
+        max_workers = args.max_workers,
+        memory_limit = args.memory_limit,
+        dask_threads = args.dask_threads,
+        **{facet: value for facet, value in [('ensemble', args.ensemble), ('rcm_version', args.rcm_version)]
+           if value is not None},
+    )
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import xarray as xr
+
+import urclimask
+
+
+class MaskCache:
+    def __init__(
+        self,
+        cache_dir : str,
+        *,
+        max_entries : int | None = None,
+        max_bytes : int | None = None,
+        checksum : bool = False,
+    ):
+        """
+        Content-addressed cache of urmask datasets.
+
+        Entries are keyed by a hash of the inputs (static field files or arrays),
+        the UrbanVicinity hyperparameters and the library version. The least
+        recently used entries are evicted when the cache grows beyond
+        `max_entries` or `max_bytes`.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory where the cached NetCDF files and the index are stored.
+        max_entries : int
+            Maximum number of cached masks (unbounded if None).
+        max_bytes : int
+            Maximum total size of the cached files in bytes (unbounded if None).
+        checksum : bool
+            Hash input files by content instead of by (path, size, mtime).
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_file = os.path.join(cache_dir, 'index.json')
+
+    def key(self, *, sources=(), params=None) -> str:
+        """
+        Cache key for a set of inputs and hyperparameters.
+
+        Parameters
+        ----------
+        sources : list
+            Input file paths, xarray objects or arrays.
+        params : dict
+            Hyperparameters that determine the mask.
+
+        Returns
+        -------
+        str
+            Hexadecimal key.
+        """
+        digest = hashlib.sha256()
+        digest.update(urclimask.__version__.encode())
+        for source in sources:
+            if source is None:
+                # Optional input not given (a fixed token, not the object address)
+                digest.update(b'__none__')
+            elif isinstance(source, (str, os.PathLike)):
+                digest.update(self._file_token(source))
+            elif isinstance(source, (xr.DataArray, xr.Dataset)):
+                if isinstance(source, xr.DataArray):
+                    source = source.to_dataset(name='__data__')
+                for name, var in sorted(source.variables.items()):
+                    digest.update(repr((name, var.dims)).encode())
+                    digest.update(np.ascontiguousarray(var.values).tobytes())
+            else:
+                digest.update(np.ascontiguousarray(source).tobytes())
+        digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _file_token(self, path):
+        if self.checksum:
+            file_digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    file_digest.update(block)
+            return file_digest.digest()
+        stat = os.stat(path)
+        return repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode()
+
+    def path(self, key) -> str:
+        """Path of the cached NetCDF file for a key."""
+        return os.path.join(self.cache_dir, f'urmask_{key}.nc')
+
+    def get(self, key) -> xr.Dataset | None:
+        """
+        Cached urmask dataset for a key (None on a miss).
+        """
+        index = self._read_index()
+        if key not in index or not os.path.exists(self.path(key)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        index[key]['last_access'] = time.time()
+        self._write_index(index)
+        return xr.load_dataset(self.path(key))
+
+    def put(self, key, ds):
+        """
+        Store a urmask dataset (or an existing urmask NetCDF file) in the cache.
+        """
+        tmp_file = f'{self.path(key)}.{os.getpid()}.tmp'
+        if isinstance(ds, (str, os.PathLike)):
+            shutil.copyfile(ds, tmp_file)
+        else:
+            ds.to_netcdf(tmp_file)
+        os.replace(tmp_file, self.path(key))
+        index = self._read_index()
+        index[key] = {'size': os.path.getsize(self.path(key)), 'last_access': time.time()}
+        self._evict(index)
+        self._write_index(index)
+
+    def clear(self):
+        """Remove all the cached entries."""
+        for key in self._read_index():
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+        self._write_index({})
+
+    @property
+    def stats(self) -> dict:
+        """Hit/miss statistics and current size of the cache."""
+        index = self._read_index()
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else np.nan,
+            'evictions': self.evictions,
+            'entries': len(index),
+            'bytes': sum(entry['size'] for entry in index.values()),
+        }
+
+    def _evict(self, index):
+        # Least recently used first
+        lru = sorted(index, key=lambda key: index[key]['last_access'])
+        total = sum(entry['size'] for entry in index.values())
+        while lru and ((self.max_entries is not None and len(index) > self.max_entries) or
+                       (self.max_bytes is not None and total > self.max_bytes)):
+            key = lru.pop(0)
+            total -= index.pop(key)['size']
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            self.evictions += 1
+
+    def _read_index(self):
+        if not os.path.exists(self._index_file):
+            return {}
+        with open(self._index_file) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_file = f'{self._index_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self._index_file)
@@ -0,0 +1,276 @@
+import contextlib
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from urclimask.utils import model_from_rcm, RCM_DICT
+
+# Hyperparameters stored in the urmask attributes that are kept in the catalog
+CATALOG_HYPERPARAMETERS = ["urban_th", "urban_sur_th", "orog_diff", "sftlf_th", "ratio_r2u",
+                           "min_city_size", "lon_city", "lat_city", "vicinity_method"]
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS masks (
+    id INTEGER PRIMARY KEY,
+    domain TEXT NOT NULL,
+    city TEXT NOT NULL,
+    model TEXT NOT NULL,
+    rcm TEXT NOT NULL,
+    urban_var TEXT NOT NULL,
+    lon_min REAL, lon_max REAL, lat_min REAL, lat_max REAL,
+    urban_cells INTEGER,
+    rural_cells INTEGER,
+    hyperparameters TEXT,
+    path TEXT NOT NULL,
+    source TEXT,
+    UNIQUE (domain, city, rcm, urban_var)
+);
+CREATE INDEX IF NOT EXISTS masks_city ON masks (city);
+CREATE INDEX IF NOT EXISTS masks_domain ON masks (domain, model);
+CREATE INDEX IF NOT EXISTS masks_bbox ON masks (lon_min, lon_max, lat_min, lat_max);
+"""
+
+
+class MaskStore:
+    def __init__(self, root : str):
+        """
+        Compact store of urban/vicinity masks with a SQLite catalog.
+
+        Masks are stored as zlib-compressed int8 NetCDF files (1 urban,
+        0 vicinity, -1 for the rest, decoded back to NaN when opened) together
+        with the flat indices of the urban and rural cells. The catalog records
+        the domain, city, model, bounding box, number of urban and rural cells
+        and hyperparameters of each mask, so masks are found without walking
+        directories.
+
+        Parameters
+        ----------
+        root : str
+            Directory holding the catalog ('catalog.sqlite') and the mask files.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.catalog_file = os.path.join(root, 'catalog.sqlite')
+        with self._connect() as db:
+            db.executescript(CATALOG_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.catalog_file)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(
+        self,
+        ds,
+        *,
+        city : str,
+        domain : str,
+        model : str,
+        urban_var : str = 'sfturf',
+        source : str | None = None,
+    ) -> int:
+        """
+        Add a urmask dataset to the store (replacing any previous version).
+
+        Parameters
+        ----------
+        ds : xarray.Dataset or str
+            Dataset with the 'urmask' variable, or the path of a urmask file.
+        city : str
+            City name.
+        domain : str
+            CORDEX domain (e.g. 'EUR-11').
+        model : str
+            Short model name (RCM_DICT key, e.g. 'REMO') or '<institute>_<rcm>' label.
+        urban_var : str
+            Urban variable used to build the mask ('sfturf' or 'sftimf').
+        source : str
+            Original location of the mask, for reference.
+
+        Returns
+        -------
+        int
+            Catalog id of the mask.
+        """
+        if isinstance(ds, (str, os.PathLike)):
+            source = source or str(ds)
+            ds = xr.load_dataset(ds)
+        rcm = RCM_DICT.get(domain, {}).get(model, model)
+        model = model_from_rcm(domain, rcm)
+
+        urmask = ds['urmask']
+        urmask = urmask.isel({dim: 0 for dim in urmask.dims[:-2]})
+        values = urmask.values
+        urban_index = np.flatnonzero(values == 1).astype(np.int32)
+        rural_index = np.flatnonzero(values == 0).astype(np.int32)
+        lon, lat = xr.broadcast(ds['lon'], ds['lat'])
+        lon = lon.transpose(*urmask.dims).values[np.isfinite(values)]
+        lat = lat.transpose(*urmask.dims).values[np.isfinite(values)]
+        bbox = [float(f(c)) if c.size else None
+                for c in (lon, lat) for f in (np.min, np.max)]
+        hyperparameters = {name: urmask.attrs[name] for name in CATALOG_HYPERPARAMETERS
+                           if name in urmask.attrs}
+
+        compact = urmask.to_dataset(name='urmask')
+        compact['urban_index'] = ('urban_cell', urban_index)
+        compact['rural_index'] = ('rural_cell', rural_index)
+        for name in ('urban_index', 'rural_index'):
+            compact[name].attrs['long_name'] = f"Flat index of the {name.split('_')[0]} cells over {urmask.dims}"
+        encoding = {
+            'urmask': {'dtype': 'int8', '_FillValue': -1, 'zlib': True, 'complevel': 4},
+            'urban_index': {'zlib': True},
+            'rural_index': {'zlib': True},
+        }
+        # The coordinates (2-D lon/lat on curvilinear grids) are most of the file
+        encoding.update({name: {'zlib': True, 'complevel': 4} for name in compact.coords})
+        relpath = os.path.join(domain, city, f'urmask-{urban_var}_{domain}-{city}_{rcm}_fx.nc')
+        path = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        compact.to_netcdf(tmp_file, encoding=encoding)
+        os.replace(tmp_file, path)
+
+        with self._connect() as db:
+            cursor = db.execute(
+                """INSERT OR REPLACE INTO masks (domain, city, model, rcm, urban_var,
+                lon_min, lon_max, lat_min, lat_max, urban_cells, rural_cells,
+                hyperparameters, path, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (domain, city, model, rcm, urban_var, *bbox, urban_index.size, rural_index.size,
+                 json.dumps(hyperparameters, default=float), relpath, source)
+            )
+            return cursor.lastrowid
+
+    def import_tree(self, root : str) -> int:
+        """
+        Import all the masks of a 'masks/CORDEX-CMIP5/DD' tree.
+
+        The domain, city, institute and RCM are taken from the directory
+        structure '<domain>-<city>/<institute>/<driving>/<experiment>/<ensemble>/<rcm>/...'.
+
+        Parameters
+        ----------
+        root : str
+            Path of the 'DD' directory.
+
+        Returns
+        -------
+        int
+            Number of imported masks.
+        """
+        imported = 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in sorted(filenames):
+                if not (filename.startswith('urmask-') and filename.endswith('.nc')):
+                    continue
+                path = os.path.join(dirpath, filename)
+                parts = os.path.relpath(path, root).split(os.sep)
+                domain = '-'.join(parts[0].split('-')[:2])
+                city = '-'.join(parts[0].split('-')[2:])
+                urban_var = filename.split('_')[0].split('-')[1]
+                try:
+                    MaskStore.add(self, path, city = city, domain = domain,
+                                  model = f'{parts[1]}_{parts[5]}', urban_var = urban_var)
+                    imported += 1
+                except (OSError, ValueError) as e:
+                    print(f"Skipping {path}: {e}")
+        return imported
+
+    def find(
+        self,
+        *,
+        city : str | None = None,
+        domain : str | None = None,
+        model : str | None = None,
+        urban_var : str | None = None,
+        bbox : tuple | None = None,
+    ) -> pd.DataFrame:
+        """
+        Look up masks in the catalog.
+
+        Parameters
+        ----------
+        city, domain, model, urban_var : str
+            Filters on the catalog columns (model matches the short name or the
+            '<institute>_<rcm>' label).
+        bbox : tuple
+            (lon_min, lat_min, lon_max, lat_max). Masks whose bounding box
+            intersects it are returned.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Matching catalog entries indexed by id, with the hyperparameters as dicts.
+        """
+        clauses, args = [], []
+        for column, value in (('city', city), ('domain', domain), ('urban_var', urban_var)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                args.append(value)
+        if model is not None:
+            clauses.append('(model = ? OR rcm = ?)')
+            args += [model, model]
+        if bbox is not None:
+            clauses.append('lon_max >= ? AND lat_max >= ? AND lon_min <= ? AND lat_min <= ?')
+            args += list(bbox)
+        query = 'SELECT * FROM masks'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self._connect() as db:
+            entries = pd.read_sql_query(query, db, params=args, index_col='id')
+        entries['hyperparameters'] = entries['hyperparameters'].map(json.loads)
+        return entries
+
+    def _path(self, entry):
+        if isinstance(entry, pd.DataFrame):
+            if len(entry) != 1:
+                raise ValueError(f"Expected a single catalog entry, got {len(entry)}")
+            entry = entry.iloc[0]
+        if isinstance(entry, pd.Series):
+            return os.path.join(self.root, entry['path'])
+        with self._connect() as db:
+            row = db.execute('SELECT path FROM masks WHERE id = ?', (int(entry),)).fetchone()
+        if row is None:
+            raise KeyError(f"Mask {entry} not found in the catalog")
+        return os.path.join(self.root, row[0])
+
+    def open(self, entry, **kwargs) -> xr.Dataset:
+        """
+        Open a stored mask lazily.
+
+        Parameters
+        ----------
+        entry : int, pandas.Series or pandas.DataFrame
+            Catalog id or (single) catalog entry returned by `find`.
+        **kwargs
+            Passed to xarray.open_dataset (e.g. chunks).
+
+        Returns
+        -------
+        xarray.Dataset
+            The mask, with 'urmask' decoded to 1 (urban), 0 (vicinity) and NaN.
+        """
+        return xr.open_dataset(MaskStore._path(self, entry), **kwargs)
+
+    def cells(self, entry) -> tuple:
+        """
+        Flat indices of the urban and rural cells of a stored mask.
+
+        Parameters
+        ----------
+        entry : int, pandas.Series or pandas.DataFrame
+            Catalog id or (single) catalog entry returned by `find`.
+
+        Returns
+        -------
+        tuple
+            (urban_index, rural_index) numpy arrays.
+        """
+        with xr.open_dataset(MaskStore._path(self, entry)) as ds:
+            return ds['urban_index'].values, ds['rural_index'].values
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0
+
+# In-memory cache of grid indices keyed by grid fingerprint
+_GRID_INDEX_CACHE = {}
+
+
+def lonlat_to_xyz(lon, lat):
+    """
+    Convert geographic coordinates to points on the unit sphere.
+
+    The euclidean (chord) distance between these points increases monotonically
+    with the haversine distance, so a KD-tree built on them returns the same
+    nearest neighbours as a haversine BallTree.
+
+    Parameters:
+    lon (array-like): Longitudes in degrees.
+    lat (array-like): Latitudes in degrees.
+
+    Returns:
+    numpy.ndarray: Array (..., 3) with the cartesian coordinates.
+    """
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    """
+    Convert unit-sphere chord lengths to great-circle distances (km).
+    """
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def km_to_chord(distance):
+    """
+    Convert great-circle distances (km) to unit-sphere chord lengths.
+    """
+    return 2 * np.sin(np.minimum(np.asarray(distance) / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def grid_fingerprint(lon, lat):
+    """
+    Fingerprint of a grid based on its shape and a hash of its coordinates.
+
+    Parameters:
+    lon (array-like): 1D or 2D longitudes.
+    lat (array-like): 1D or 2D latitudes.
+
+    Returns:
+    str: Hexadecimal fingerprint.
+    """
+    lon = np.ascontiguousarray(lon, dtype=float)
+    lat = np.ascontiguousarray(lat, dtype=float)
+    digest = hashlib.sha1()
+    digest.update(repr((lon.shape, lat.shape)).encode())
+    digest.update(lon.tobytes())
+    digest.update(lat.tobytes())
+    return digest.hexdigest()
+
+
+class GridIndex:
+    def __init__(self, lon, lat):
+        """
+        Nearest-cell spatial index on haversine distance for a model grid.
+
+        Parameters
+        ----------
+        lon : numpy.ndarray
+            1D (rectilinear) or 2D (curvilinear) longitudes of the cell centers.
+        lat : numpy.ndarray
+            1D (rectilinear) or 2D (curvilinear) latitudes of the cell centers.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        if lon.ndim == 1:
+            lon, lat = np.meshgrid(lon, lat)
+        self.shape = lon.shape
+        self.fingerprint = None
+        # Cells with missing coordinates cannot be selected
+        valid = np.isfinite(lon) & np.isfinite(lat)
+        self._cells = np.flatnonzero(valid)
+        self._tree = cKDTree(lonlat_to_xyz(lon.ravel()[self._cells],
+                                           lat.ravel()[self._cells]))
+
+    def query(self, lon, lat, return_distance=False):
+        """
+        Locate the grid cells closest to one or several points.
+
+        Parameters
+        ----------
+        lon : float or array-like
+            Longitude(s) of the points.
+        lat : float or array-like
+            Latitude(s) of the points.
+        return_distance : bool
+            If True, also return the great-circle distance (km) to the cell center.
+
+        Returns
+        -------
+        tuple
+            (iy, ix) indices of the closest cells along the grid dimensions
+            (and the distances in km if requested). Scalars for scalar input.
+        """
+        chord, nearest = self._tree.query(lonlat_to_xyz(lon, lat))
+        iy, ix = np.unravel_index(self._cells[nearest], self.shape)
+        if return_distance:
+            return iy, ix, chord_to_km(chord)
+        return iy, ix
+
+    @property
+    def spacing(self):
+        """
+        Grid spacing (km): median distance from the cell centers to their nearest neighbour.
+        """
+        if getattr(self, '_spacing', None) is None:
+            if self._tree.n < 2:
+                self._spacing = np.nan
+            else:
+                chord, _ = self._tree.query(self._tree.data, k=2)
+                self._spacing = float(np.median(chord_to_km(chord[:, 1])))
+        return self._spacing
+
+
+def get_grid_index(lon, lat, cache_dir=None):
+    """
+    Return the spatial index of a grid, building it only once per grid fingerprint.
+
+    Indices are kept in memory for the lifetime of the process and, if
+    `cache_dir` is given, pickled to disk so that other processes reuse them.
+
+    Parameters:
+    lon (numpy.ndarray): 1D or 2D longitudes of the cell centers.
+    lat (numpy.ndarray): 1D or 2D latitudes of the cell centers.
+    cache_dir (str, optional): Directory for the on-disk cache.
+
+    Returns:
+    GridIndex: The spatial index of the grid.
+    """
+    fingerprint = grid_fingerprint(lon, lat)
+    index = _GRID_INDEX_CACHE.get(fingerprint)
+    if index is not None:
+        return index
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'grid-index_{fingerprint}.pkl')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                index = pickle.load(f)
+
+    if index is None:
+        index = GridIndex(lon, lat)
+        index.fingerprint = fingerprint
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(tmp_file, cache_file)
+
+    _GRID_INDEX_CACHE[fingerprint] = index
+    return index
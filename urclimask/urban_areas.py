@@ -1,25 +1,148 @@
 
 import cartopy.crs as ccrs
+import cf_xarray  # registers the .cf accessor
+import copy
 import dask
+import dask.array
 import pandas as pd
 import geopandas as gpd
 import glob
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import time
 import xarray as xr
+import yaml
+from concurrent.futures import ProcessPoolExecutor
 from icecream import ic
 from itertools import product
 from matplotlib.colors import LinearSegmentedColormap
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from skimage.morphology import dilation, square, remove_small_objects
 from  skimage import measure, morphology
+from scipy.ndimage import find_objects
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.graph import MCP_Geometric
 
+from urclimask.mask_cache import MaskCache
+from urclimask.spatial_index import get_grid_index
+from urclimask.utils import cell_area_coverage, fix_360_longitudes, kelvin2degC, plot_urban_polygon, RCM_DICT
 
-from shapely.geometry import box
-from shapely.geometry import Polygon
+# Hyperparameters that can be set per city in the cities configuration (YAML)
+CITY_HYPERPARAMETERS = ["urban_th", "urban_sur_th", "orog_diff", "sftlf_th", "ratio_r2u",
+                        "min_city_size", "lon_lim", "lat_lim", "vicinity_method"]
 
-from urclimask.utils import plot_urban_polygon
+def rank_vicinity(distance, n_cells):
+    """
+    Flat indices of the `n_cells` candidate cells closest to the urban core.
+
+    Ties are broken by position (row-major order), so the selection is
+    deterministic and has exactly `n_cells` cells (or all reachable cells
+    if there are fewer).
+
+    Parameters
+    ----------
+    distance : numpy.ndarray
+        Distance field from `UrbanVicinity.vicinity_distance` (inf for non-candidates).
+    n_cells : int
+        Number of rural cells to select.
+
+    Returns
+    -------
+    numpy.ndarray
+        Flat indices of the selected cells.
+    """
+    flat = np.ravel(distance)
+    reachable = np.flatnonzero(np.isfinite(flat))
+    if reachable.size < n_cells:
+        print(f"Warning: Only {reachable.size} non-urban cells can be found ({n_cells} requested)")
+    order = reachable[np.argsort(flat[reachable], kind='stable')]
+    return order[:n_cells]
+
+def city_hyperparameters(cities, city):
+    """
+    UrbanVicinity arguments for one entry of the cities configuration.
+
+    Parameters
+    ----------
+    cities : dict
+        Cities configuration (e.g. selected_cities.yaml), with optional 'DEFAULT' entry.
+    city : str
+        Entry key in the form '<city>_<model>_<urban_var>'.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for UrbanVicinity.
+    """
+    config = {**cities.get('DEFAULT', {}), **cities[city]}
+    params = {key: config[key] for key in CITY_HYPERPARAMETERS if key in config}
+    params.update(
+        lon_city = config['lon'],
+        lat_city = config['lat'],
+        domain = config['domain'],
+        model = city.split('_')[1],
+        urban_var = city.split('_')[2],
+    )
+    return params
+
+def mask_drs_path(domain, city, urban_var, drs):
+    """
+    Relative path of a mask in the DRS layout of the masks tree
+    ('masks/CORDEX-CMIP5/DD'), read by `urclimask.mask_store.MaskStore.import_tree`.
+
+    Parameters
+    ----------
+    domain : str
+        CORDEX domain (e.g. 'EUR-11').
+    city : str
+        City name (e.g. 'Paris').
+    urban_var : str
+        Urban variable (e.g. 'sfturf').
+    drs : dict
+        DRS facets of the static fields ('institute', 'driving_model', 'experiment',
+        'ensemble', 'rcm' and 'rcm_version', e.g. a `FileCatalog` entry), the
+        mask 'version' (e.g. 'v20250601') and optionally the 'run_ensemble' the
+        file is named after (the static fields ensemble by default).
+
+    Returns
+    -------
+    str
+        '<domain>-<city>/<institute>/<driving_model>/<experiment>/<ensemble>/<rcm>/<rcm_version>/fx/urmask-<urban_var>/<version>/<file>'
+    """
+    ensemble = drs.get('run_ensemble') or drs['ensemble']
+    filename = (f"urmask-{urban_var}_{domain}-{city}_{drs['driving_model'].replace('-', '_')}_"
+                f"{drs['experiment']}_{ensemble}_{drs['institute']}_{drs['rcm']}_fx.nc")
+    return os.path.join(
+        f'{domain}-{city}', drs['institute'], drs['driving_model'], drs['experiment'],
+        drs['ensemble'], drs['rcm'], drs['rcm_version'], 'fx', f'urmask-{urban_var}',
+        drs['version'], filename
+    )
+
+
+def _run_batch_city(urban, ds_sfturf, ds_orog, ds_sftlf, path):
+    """
+    Compute and write the urban/vicinity mask of one city (batch worker).
+    """
+    start = time.perf_counter()
+    sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask = urban.define_masks(
+        ds_sfturf = ds_sfturf,
+        ds_orog = ds_orog,
+        ds_sftlf = ds_sftlf,
+    )
+    urmask = urban.select_urban_vicinity(
+        sfturf_mask = sfturf_mask,
+        orog_mask = orog_mask,
+        sftlf_mask = sftlf_mask,
+        sfturf_sur_mask = sfturf_sur_mask
+    )
+    urmask.to_netcdf(path)
+    return {
+        'urban_cells': int((urmask['urmask'] == 1).sum()),
+        'rural_cells': int((urmask['urmask'] == 0).sum()),
+        'seconds': time.perf_counter() - start,
+    }
 
 class UrbanVicinity:
     def __init__(
@@ -38,6 +161,7 @@ class UrbanVicinity:
         model : str | None = None,
         domain : str | None = None,
         urban_var : str | None = None,
+        vicinity_method : str = 'dilation',
     ):
         """
         Hyperparameters requered for urban/rural area selection
@@ -71,6 +195,9 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
             Mode domain (if applicable)
         urban_var : str
             Name of the urban static field (if applicable)
+        vicinity_method : str
+            Method to select the rural vicinity: 'dilation' (iterative morphological
+            dilation) or 'distance' (single-pass ranking by constrained distance).
         """        
         self.urban_th = urban_th
         self.urban_sur_th = urban_sur_th
@@ -85,12 +212,14 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         self.model = model
         self.domain = domain
         self.urban_var = urban_var
+        self.vicinity_method = vicinity_method
 
     def crop_area_city(
         self, 
         *,
         ds : xr.DataArray | None = None,
-        res : int | None = None
+        res : int | None = None,
+        index_cache_dir : str | None = None,
         ) -> xr.DataArray:
         """
         Select area around a central city point.
@@ -101,43 +230,154 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
             xarray with longitud and latitud.
         res : xarray.DataArray
             Domain resolution (e.g. 11/22).
+        index_cache_dir : str
+            Directory to store the spatial index of the grid on disk (optional).
             
         Returns
         -------
         ds : xarray.DataArray
             Cropped xarray.
         """
-        # number of cells around the city
-        dlon = int(111*self.lon_lim/res)
-        dlat = int(111*self.lat_lim/res)
-        # select point close the city
-        dist = (ds['lon']-self.lon_city)**2 + (ds['lat']-self.lat_city)**2
-        [ilat], [ilon] = np.where(dist == np.min(dist))
+        return ds.isel(UrbanVicinity.crop_window(self, ds = ds, res = res,
+                                                 index_cache_dir = index_cache_dir))
+
+    def crop_window(
+        self,
+        *,
+        ds : xr.DataArray | None = None,
+        res : int | None = None,
+        index_cache_dir : str | None = None,
+        ) -> dict:
+        """
+        Index window of the area around a central city point.
+
+        Parameters
+        ----------
+        ds : xarray.DataArray 
+            xarray with longitud and latitud.
+        res : xarray.DataArray
+            Domain resolution (e.g. 11/22).
+        index_cache_dir : str
+            Directory to store the spatial index of the grid on disk (optional).
+
+        Returns
+        -------
+        dict
+            Slices along the grid dimensions, to be used with `isel`.
+        """
         if ds.lon.ndim == 2:
-        # crop area
+            # number of cells around the city
+            dlon = int(111*self.lon_lim/res)
+            dlat = int(111*self.lat_lim/res)
+            # select point close the city (index built once per grid)
+            index = get_grid_index(ds['lon'].values, ds['lat'].values,
+                                   cache_dir=index_cache_dir)
+            ilat, ilon = index.query(self.lon_city, self.lat_city)
             try:
-                ds = ds.isel(**{
-                    ds.cf['Y'].name: slice(ilat - dlat, ilat + dlat),
-                    ds.cf['X'].name: slice(ilon - dlon, ilon + dlon)
-                })
+                ydim, xdim = ds.cf['Y'].name, ds.cf['X'].name
             except (KeyError, ValueError):
                 # Fallback directo si cf_xarray no reconoce 'X' y 'Y'
-                ds = ds.isel(
-                    y=slice(ilat - dlat, ilat + dlat),
-                    x=slice(ilon - dlon, ilon + dlon)
-            )
-         
+                ydim, xdim = 'y', 'x'
+            return {
+                ydim: slice(max(ilat - dlat, 0), ilat + dlat),
+                xdim: slice(max(ilon - dlon, 0), ilon + dlon),
+            }
         else:
-         		# Crop the area for the city using the domain resolution
-            # Define trimming limits
-            lat_min = self.lat_city - self.lat_lim
-            lat_max = self.lat_city + self.lat_lim
-            lon_min = self.lon_city - self.lon_lim
-            lon_max = self.lon_city + self.lon_lim
-            
-            # Crop the dataset
-            ds = ds.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
-        return ds
+            # Crop the area for the city using the domain resolution
+            return {
+                'lat': ds.indexes['lat'].slice_indexer(self.lat_city - self.lat_lim,
+                                                       self.lat_city + self.lat_lim),
+                'lon': ds.indexes['lon'].slice_indexer(self.lon_city - self.lon_lim,
+                                                       self.lon_city + self.lon_lim),
+            }
+
+    def open_city_dataset(
+        self,
+        files,
+        variable : str,
+        *,
+        res : int | None = None,
+        index_cache_dir : str | None = None,
+        time_chunk : int = -1,
+        **kwargs,
+        ) -> xr.Dataset:
+        """
+        Open a multi-file dataset reading only the area around the city.
+
+        The crop window is computed once from the first file and applied
+        file by file in the `preprocess` step of `xarray.open_mfdataset`,
+        together with the longitude fix and the conversion to Celsius, so
+        only the city window is read from disk.
+
+        Parameters
+        ----------
+        files : list
+            Files to open (concatenated along time in sorted order).
+        variable : str
+            Variable to read.
+        res : int
+            Domain resolution (e.g. 11/22).
+        index_cache_dir : str
+            Directory to store the spatial index of the grid on disk (optional).
+        time_chunk : int
+            Time steps per chunk within each file. By default, one chunk per
+            file, which suits climatology reductions over the small city window.
+        **kwargs
+            Passed to xarray.open_mfdataset.
+
+        Returns
+        -------
+        xarray.Dataset
+            Dataset with `variable` cropped around the city.
+        """
+        files = sorted(files)
+        preprocess = UrbanVicinity.city_preprocess(self, files[0], variable, res = res,
+                                                   index_cache_dir = index_cache_dir)
+        return xr.open_mfdataset(
+            files, combine = 'nested', concat_dim = 'time', preprocess = preprocess,
+            chunks = {'time': time_chunk}, **kwargs
+        )
+
+    def city_preprocess(
+        self,
+        file : str,
+        variable : str,
+        *,
+        res : int | None = None,
+        index_cache_dir : str | None = None,
+        ):
+        """
+        Function cropping a dataset of the model grid around the city.
+
+        The crop window is computed once from `file`. The function selects
+        `variable`, crops it, fixes the longitudes and converts Kelvin to
+        Celsius (as `open_city_dataset` does for every file).
+
+        Parameters
+        ----------
+        file : str
+            A file of the model grid.
+        variable : str
+            Variable to read.
+        res : int
+            Domain resolution (e.g. 11/22).
+        index_cache_dir : str
+            Directory to store the spatial index of the grid on disk (optional).
+
+        Returns
+        -------
+        callable
+            Function taking and returning an xarray.Dataset.
+        """
+        with xr.open_dataset(file) as ds:
+            window = UrbanVicinity.crop_window(self, ds = fix_360_longitudes(ds), res = res,
+                                               index_cache_dir = index_cache_dir)
+
+        def preprocess(ds):
+            ds = fix_360_longitudes(ds[[variable]].isel(window))
+            return kelvin2degC(ds, variable)
+
+        return preprocess
 
 
     def remove_small_city(self,
@@ -158,8 +398,21 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
             A cleaned binary mask where small objects have been removed, 
             preserving only the main urban region.
         """
+        cleaned_mask = UrbanVicinity._main_city(
+            self, mask.values, mask.cf['lat'].values, mask.cf['lon'].values)
+    
+        # Return the result as an xarray.DataArray with the original coordinates
+        return xr.DataArray(
+            cleaned_mask.astype(int),
+            coords=mask.coords,
+            dims=mask.dims)
+
+    def _main_city(self, mask, lat, lon):
+        """
+        Array version of `remove_small_city` (boolean mask and coordinate arrays).
+        """
         # Label connected regions in the mask
-        labeled_mask = measure.label(mask.values)
+        labeled_mask = measure.label(mask)
     
         # Remove small objects based on a minimum city size threshold
         cleaned_mask = morphology.remove_small_objects(labeled_mask, min_size=self.min_city_size)
@@ -167,8 +420,8 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         # If all objects were removed, select the region closest to the city center
         if np.max(cleaned_mask) == 0:
             # Calculate pixel indices closest to the city center coordinates
-            y_center = np.abs(mask.cf['lat'].values - self.lat_city).argmin()
-            x_center = np.abs(mask.cf['lon'] - self.lon_city).argmin()
+            y_center = np.abs(lat - self.lat_city).argmin()
+            x_center = np.abs(lon - self.lon_city).argmin()
             center_pixel = np.array([y_center, x_center])
     
             # Compute distances from each region centroid to the city center
@@ -186,12 +439,7 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         else:
             # If objects remain, set the cleaned_mask to 1 (urban) and 0 (non-urban)
             cleaned_mask = (cleaned_mask > 0)
-    
-        # Return the result as an xarray.DataArray with the original coordinates
-        return xr.DataArray(
-            cleaned_mask.astype(int),
-            coords=mask.coords,
-            dims=mask.dims)
+        return cleaned_mask
 
     def define_masks(
         self, 
@@ -199,6 +447,7 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         ds_sfturf : xr.DataArray | None = None, 
         ds_orog : xr.DataArray | None = None, 
         ds_sftlf: xr.DataArray | None = None,
+        lazy: bool = False,
     )-> xr.DataArray:
         """
         Define masks for urban fraction, orography and land-sea mask.
@@ -211,6 +460,9 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
             Orogrhapy (m)
         ds_sftlf : xarray.DataArray
             Land-sea percentaje (%)
+        lazy : bool
+            Build the four masks and the urban elevation limits as a single dask
+            graph and evaluate them with one compute (for dask-backed inputs).
             
         Returns
         -------
@@ -223,6 +475,9 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         sftlf_mask : xarray.DataArray
             Binary mask indicating sea areas.
         """
+        if lazy:
+            return UrbanVicinity._define_masks_lazy(
+                self, ds_sfturf = ds_sfturf, ds_orog = ds_orog, ds_sftlf = ds_sftlf)
         # sfturf
         sfturf_mask = ds_sfturf[self.urban_var] > self.urban_th
         # Remove small objects
@@ -253,6 +508,58 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
     
         return sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask
 
+    def _define_masks_lazy(self, *, ds_sfturf, ds_orog, ds_sftlf):
+        """
+        Lazy version of `define_masks` evaluated with a single dask compute.
+        """
+        # Non-index coordinates (e.g. 2D lon/lat) are dropped while building the graph,
+        # otherwise xarray computes them to check that they match between fields
+        coords = ds_sfturf[self.urban_var].coords
+        sfturf = ds_sfturf[self.urban_var].reset_coords(drop=True)
+        orog = ds_orog["orog"].reset_coords(drop=True)
+        sftlf = ds_sftlf["sftlf"].reset_coords(drop=True)
+        lat, lon = [
+            xr.DataArray(coord.data, dims=coord.dims)
+            for coord in (ds_sfturf[self.urban_var].cf['lat'], ds_sfturf[self.urban_var].cf['lon'])
+        ]
+        urban_all = sfturf > self.urban_th
+        # Connected-component labeling is the only step that needs the whole field
+        urban = xr.apply_ufunc(
+            lambda mask, lat, lon: UrbanVicinity._main_city(self, mask, lat, lon),
+            urban_all.chunk(), lat, lon,
+            input_core_dims=[urban_all.dims, lat.dims, lon.dims],
+            output_core_dims=[urban_all.dims],
+            dask='parallelized',
+            output_dtypes=[bool],
+            dask_gufunc_kwargs={'allow_rechunk': True},
+        ).transpose(*urban_all.dims)
+        # As in the eager mode, every cell above the urban threshold (including the
+        # deleted small nuclei) belongs to the surroundings mask
+        sfturf_sur_mask = urban_all | ((sfturf <= self.urban_th) & (sfturf > self.urban_sur_th))
+        # orog
+        urban_elev_max = orog.where(urban).max()
+        urban_elev_min = orog.where(urban).min()
+        orog_mask = ((orog < (self.orog_diff + urban_elev_max)) &
+                     (orog > (urban_elev_min - self.orog_diff)))
+        #sftlf
+        sftlf_mask = sftlf > self.sftlf_th
+        # Apply sftlf threshold to the urban masks
+        sfturf_mask = (urban & sftlf_mask).astype(int)
+        sfturf_sur_mask = sfturf_sur_mask & sftlf_mask
+        sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask = [
+            mask.assign_coords(coords)
+            for mask in (sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask)
+        ]
+
+        (sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask,
+         urban_elev_max, urban_elev_min) = dask.compute(
+            sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask,
+            urban_elev_max, urban_elev_min)
+        self.urban_elev_min = urban_elev_min.item()
+        self.urban_elev_max = urban_elev_max.item()
+
+        return sfturf_mask, sfturf_sur_mask, orog_mask, sftlf_mask
+
 
     def select_urban_vicinity(
         self,
@@ -261,7 +568,9 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         orog_mask : xr.DataArray | None = None,
         sftlf_mask : xr.DataArray | None = None,
         sfturf_sur_mask : xr.DataArray | None = None,
-        ratio_r2u: int | None = None
+        ratio_r2u: int | None = None,
+        method: str | None = None,
+        cache: MaskCache | None = None,
     ) -> xr.DataArray:
         """
         Funtion to select a number of non-urban cells based on surrounding urban areas using a dilation operation and excluding large water bodies, mountains and small urban nuclei.
@@ -278,6 +587,10 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
             Binary mask indicating surroundings of urban areas affected by the urban effect with 1 and 0 for the rest.
         ratio_r2u : int 
             Urban-rural ratio of grid boxes.
+        method : str
+            'dilation' or 'distance' (defaults to the `vicinity_method` hyperparameter).
+        cache : urclimask.mask_cache.MaskCache
+            Reuse the mask if it was already computed for the same inputs and hyperparameters.
     
         Returns
         -------
@@ -304,6 +617,45 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         
         if ratio_r2u is None:
             ratio_r2u = self.ratio_r2u
+        if method is None:
+            method = self.vicinity_method
+
+        if cache is not None:
+            key = cache.key(
+                sources = [sfturf_mask, orog_mask, sftlf_mask, sfturf_sur_mask],
+                params = {**self.hyperparameters(), 'ratio_r2u': ratio_r2u, 'vicinity_method': method}
+            )
+            urban_area = cache.get(key)
+            if urban_area is None:
+                urban_area = UrbanVicinity.select_urban_vicinity(
+                    self,
+                    sfturf_mask = sfturf_mask,
+                    orog_mask = orog_mask,
+                    sftlf_mask = sftlf_mask,
+                    sfturf_sur_mask = sfturf_sur_mask,
+                    ratio_r2u = ratio_r2u,
+                    method = method
+                )
+                cache.put(key, urban_area)
+            return urban_area
+        
+        if method == 'distance':
+            distance = UrbanVicinity.vicinity_distance(
+                self,
+                sfturf_mask = sfturf_mask,
+                orog_mask = orog_mask,
+                sftlf_mask = sftlf_mask,
+                sfturf_sur_mask = sfturf_sur_mask
+            )
+            self.vicinity_distance_field = distance
+            urban_cells = int(np.sum(sfturf_mask))
+            selected = rank_vicinity(distance.values, int(round(urban_cells * ratio_r2u)))
+            vicinity = np.zeros(distance.shape, dtype=int)
+            vicinity.flat[selected] = 1
+            vicinity = xr.DataArray(vicinity, coords=sfturf_mask.coords, dims=sfturf_mask.dims)
+            return UrbanVicinity._assemble_urmask(self, sfturf_mask, vicinity, method)
+        elif method != 'dilation':
+            raise ValueError(f"Unknown vicinity method '{method}'. Use 'dilation' or 'distance'.")
         
         data_array = xr.DataArray(sfturf_mask).astype(int)
 
@@ -337,6 +689,12 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
 
         # Delete surrounding intersectig with dilated data
         dilated_data = delete_surrounding_intersect(dilated_data, sfturf_sur_mask)  
+        return UrbanVicinity._assemble_urmask(self, sfturf_mask, dilated_data, method)
+
+    def _assemble_urmask(self, sfturf_mask, dilated_data, method):
+        """
+        Build the urmask dataset from the urban mask and the selected (dilated) cells.
+        """
         # Assing rural cells (1), vicinity (0) and the rest (nan) 
         non_urban_mask = xr.DataArray(dilated_data.where(~sfturf_mask).fillna(0))
         urban_area = sfturf_mask.astype(int).where(sfturf_mask.astype(int) == 1, np.nan)
@@ -344,11 +702,460 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         urban_area = urban_area.to_dataset(name='urmask')
         # Add attributes
         urban_area = UrbanVicinity.netcdf_attrs(self, urban_area)
+        urban_area['urmask'].attrs['vicinity_method'] = method
         
         return urban_area
+
+    def vicinity_distance(
+        self,
+        *,
+        sfturf_mask : xr.DataArray | None = None,
+        orog_mask : xr.DataArray | None = None,
+        sftlf_mask : xr.DataArray | None = None,
+        sfturf_sur_mask : xr.DataArray | None = None,
+    ) -> xr.DataArray:
+        """
+        Constrained distance transform from the urban core.
+
+        Distances (in grid cells, sqrt(2) for diagonal steps) are propagated in a
+        single pass through the cells allowed by the orography and land-sea masks,
+        as the dilation does. Cells in the urban surroundings mask can be crossed
+        but are never candidates, so they get an infinite distance, as do urban
+        cells and cells that cannot be reached.
+
+        Parameters
+        ----------
+        sfturf_mask : xarray.DataArray 
+            Binary mask indicating urban areas with 1 and 0 for the rest.
+        orog_mask : xarray.DataArray
+            Binary mask indicating of orography with .
+        sftlf_mask : xarray.DataArray
+            Binary mask indicating sea areas.
+        sfturf_sur_mask : xarray.DataArray 
+            Binary mask indicating surroundings of urban areas affected by the urban effect with 1 and 0 for the rest.
+
+        Returns
+        -------
+        xarray.DataArray
+            Distance of every candidate rural cell to the urban core (inf for the rest).
+        """
+        urban = np.asarray(sfturf_mask, dtype=bool)
+        allowed = np.asarray(orog_mask, dtype=bool) & np.asarray(sftlf_mask, dtype=bool)
+        distance = np.full(urban.shape, np.inf)
+        if urban.any():
+            costs = np.where(allowed | urban, 1.0, np.inf)
+            distance, _ = MCP_Geometric(costs, fully_connected=True).find_costs(np.argwhere(urban))
+        candidates = allowed & ~urban & ~np.asarray(sfturf_sur_mask, dtype=bool)
+        return xr.DataArray(
+            np.where(candidates, distance, np.inf),
+            coords=sfturf_mask.coords,
+            dims=sfturf_mask.dims,
+            name='vicinity_distance')
             
     
 
+    def sweep(
+        self,
+        param_grid : dict,
+        *,
+        ds_sfturf : xr.Dataset | None = None,
+        ds_orog : xr.Dataset | None = None,
+        ds_sftlf : xr.Dataset | None = None,
+        method : str | None = None,
+    ) -> xr.Dataset:
+        """
+        Evaluate the urban/vicinity mask for every combination of hyperparameters.
+
+        Connected urban components are labeled once per `urban_th`. With the
+        'distance' vicinity method the distance field is computed once per
+        combination of the mask hyperparameters, and every `ratio_r2u` is a
+        threshold on it. With the 'dilation' method the dilation is run for
+        every combination, as in `select_urban_vicinity`.
+
+        Parameters
+        ----------
+        param_grid : dict
+            Values to evaluate for some of 'urban_th', 'urban_sur_th', 'orog_diff',
+            'sftlf_th', 'min_city_size' and 'ratio_r2u' (the rest are taken from self).
+        ds_sfturf : xarray.Dataset 
+            Urban fraction (0-1)
+        ds_orog : xarray.Dataset
+            Orogrhapy (m)
+        ds_sftlf : xarray.Dataset
+            Land-sea percentaje (%)
+        method : str
+            'dilation' or 'distance' (defaults to the `vicinity_method` hyperparameter).
+
+        Returns
+        -------
+        xarray.Dataset
+            'urmask' stacked along a 'param' dimension (one value per combination, with
+            the hyperparameters as coordinates), the number of urban and rural cells
+            per combination and the frequency of each cell being urban or rural.
+        """
+        if method is None:
+            method = self.vicinity_method
+        if method not in ('dilation', 'distance'):
+            raise ValueError(f"Unknown vicinity method '{method}'. Use 'dilation' or 'distance'.")
+        names = ["urban_th", "urban_sur_th", "orog_diff", "sftlf_th", "min_city_size", "ratio_r2u"]
+        unknown = set(param_grid) - set(names)
+        if unknown:
+            raise ValueError(f"Parameters {sorted(unknown)} cannot be swept. Use {names}.")
+        values = [np.atleast_1d(param_grid.get(name, getattr(self, name))) for name in names]
+        combinations = list(product(*values))
+
+        sfturf = ds_sfturf[self.urban_var]
+        urban_fraction = sfturf.values
+        orog = ds_orog['orog'].values
+        sftlf = ds_sftlf['sftlf'].values
+
+        labels = {}
+        masks = {}
+        urmask = np.full((len(combinations),) + urban_fraction.shape, np.nan)
+        for n, (urban_th, urban_sur_th, orog_diff, sftlf_th, min_city_size, ratio_r2u) in enumerate(combinations):
+            key = (urban_th, urban_sur_th, orog_diff, sftlf_th, min_city_size)
+            if key not in masks:
+                # Connected components (once per urban threshold)
+                if urban_th not in labels:
+                    labeled = measure.label(urban_fraction > urban_th)
+                    labels[urban_th] = (labeled, np.bincount(labeled.ravel()))
+                labeled, sizes = labels[urban_th]
+                keep = sizes >= min_city_size
+                keep[0] = False
+                if keep.any():
+                    urban = keep[labeled]
+                else:
+                    # Fall back to the urban nucleus closest to the city center
+                    urban_small = copy.copy(self)
+                    urban_small.min_city_size = min_city_size
+                    urban = UrbanVicinity.remove_small_city(
+                        urban_small, mask = sfturf > urban_th).values.astype(bool)
+                # As in `define_masks`, every cell above the urban threshold belongs to
+                # the surroundings mask (the dilation counts them)
+                surroundings = (urban_fraction > urban_th)
+                surroundings |= (urban_fraction <= urban_th) & (urban_fraction > urban_sur_th)
+                if urban.any():
+                    orog_mask = ((orog < orog_diff + orog[urban].max()) &
+                                 (orog > orog[urban].min() - orog_diff))
+                else:
+                    orog_mask = np.zeros(urban.shape, dtype=bool)
+                sftlf_mask = sftlf > sftlf_th
+                urban = urban & sftlf_mask
+                mask_arrays = {
+                    name: xr.DataArray(mask, coords=sfturf.coords, dims=sfturf.dims)
+                    for name, mask in (('sfturf_mask', urban), ('orog_mask', orog_mask),
+                                       ('sftlf_mask', sftlf_mask),
+                                       ('sfturf_sur_mask', surroundings & sftlf_mask))
+                }
+                if method == 'distance':
+                    distance = UrbanVicinity.vicinity_distance(self, **mask_arrays).values
+                    # Candidates ranked once, every ratio is a prefix of this ranking
+                    masks[key] = (urban, rank_vicinity(distance, np.isfinite(distance).sum()))
+                else:
+                    masks[key] = (urban, mask_arrays)
+            urban, selection = masks[key]
+            if method == 'distance':
+                urmask[n][urban] = 1
+                urmask[n].flat[selection[:int(round(urban.sum() * ratio_r2u))]] = 0
+            else:
+                urmask[n] = UrbanVicinity.select_urban_vicinity(
+                    self, **selection, ratio_r2u = ratio_r2u, method = method)['urmask'].values
+
+        params = {
+            name: ('param', np.array([combination[i] for combination in combinations]))
+            for i, name in enumerate(names)
+        }
+        ds = xr.Dataset(
+            {'urmask': (('param',) + sfturf.dims, urmask)},
+            coords={**sfturf.coords, **params, 'param': np.arange(len(combinations))}
+        )
+        ds['urban_cells'] = (ds['urmask'] == 1).sum(sfturf.dims)
+        ds['rural_cells'] = (ds['urmask'] == 0).sum(sfturf.dims)
+        ds['urban_frequency'] = (ds['urmask'] == 1).mean('param')
+        ds['rural_frequency'] = (ds['urmask'] == 0).mean('param')
+        ds['urmask'].attrs['long_name'] = 'Urban vs. vicinity. 1 corresponds to urban areas and 0 to the surrounding areas'
+        ds['urmask'].attrs['vicinity_method'] = method
+        ds['urban_frequency'].attrs['long_name'] = 'Fraction of parameter combinations classifying the cell as urban'
+        ds['rural_frequency'].attrs['long_name'] = 'Fraction of parameter combinations classifying the cell as vicinity'
+        return ds
+
+    def plot_sweep_frequency(self, ds_sweep):
+        """
+        Plot how often each cell is classified as urban or vicinity in a sweep.
+
+        Parameters
+        ----------
+        ds_sweep : xarray.Dataset
+            Output of `UrbanVicinity.sweep`.
+        """
+        proj = ccrs.PlateCarree()
+        fig, axes = plt.subplots(1, 2, subplot_kw={'projection': proj}, figsize=(16, 6))
+        for ax, var, cmap, title in zip(axes,
+                                        ['urban_frequency', 'rural_frequency'],
+                                        ['Reds', 'Greens'],
+                                        ['Urban', 'Vicinity']):
+            im = ax.pcolormesh(ds_sweep.lon, ds_sweep.lat,
+                               ds_sweep[var].where(ds_sweep[var] > 0),
+                               cmap=cmap, vmin=0, vmax=1)
+            fig.colorbar(im, ax=ax)
+            ax.set_title(f"{title} frequency ({ds_sweep.sizes['param']} combinations)")
+            ax.coastlines()
+        return fig
+
+    def mask_atlas(
+        self,
+        *,
+        ds_sfturf : xr.Dataset | None = None,
+        ds_orog : xr.Dataset | None = None,
+        ds_sftlf : xr.Dataset | None = None,
+        tile_size : int = 256,
+        halo : int | None = None,
+        max_halo : int = 64,
+    ) -> xr.Dataset:
+        """
+        Urban/vicinity masks for every urban cluster of a whole domain.
+
+        Urban clusters are labeled tile by tile and merged across tile boundaries
+        through a global label-equivalence table, so clusters crossing tiles get a
+        single id. Only the tile edges and a few statistics per label are kept, not
+        full-domain arrays. The vicinity candidates of each cluster are ranked with
+        the 'distance' method in a window around the cluster extended by a halo,
+        independently of the tiles, so the selection is not truncated at tile
+        edges. Cells claimed by several clusters go to the closest one, and the
+        other clusters take their next candidates. The atlas is returned as dask
+        arrays with one chunk per tile, computed (e.g. when written with
+        `to_netcdf`) one tile at a time, so memory is bounded by the tile size
+        and the largest cluster window.
+
+        Parameters
+        ----------
+        ds_sfturf : xarray.Dataset 
+            Urban fraction of the whole domain.
+        ds_orog : xarray.Dataset
+            Orogrhapy (m) of the whole domain.
+        ds_sftlf : xarray.Dataset
+            Land-sea percentaje (%) of the whole domain.
+        tile_size : int
+            Number of cells along each dimension of the labeling tiles.
+        halo : int
+            Number of cells added around each cluster for the vicinity selection.
+            By default it is estimated from the cluster size and `ratio_r2u` and
+            enlarged if not enough vicinity cells are found.
+        max_halo : int
+            Maximum halo (in cells) around each cluster.
+
+        Returns
+        -------
+        xarray.Dataset
+            'cluster_id' of the urban cells, 'vicinity_id' (cluster owning each
+            vicinity cell), 'urmask' (1 urban, 0 vicinity, NaN the rest) and the
+            number of urban and rural cells per cluster.
+        """
+        sfturf, orog_field, sftlf_field = [
+            field.isel({dim: 0 for dim in field.dims[:-2]})
+            for field in (ds_sfturf[self.urban_var], ds_orog['orog'], ds_sftlf['sftlf'])
+        ]
+        ydim, xdim = sfturf.dims
+        ny, nx = sfturf.shape
+        tiles = list(product(range(0, ny, tile_size), range(0, nx, tile_size)))
+
+        def read(field, window):
+            return field.isel({ydim: window[0], xdim: window[1]}).values
+
+        def tile_window(y0, x0):
+            return (slice(y0, min(y0 + tile_size, ny)), slice(x0, min(x0 + tile_size, nx)))
+
+        # Label urban clusters tile by tile. Only the size, first cell and bounding box
+        # of every tile label and the labels along the tile edges are kept
+        offsets = {}
+        edges = {}
+        stats = []
+        n_labels = 0
+        for y0, x0 in tiles:
+            tile_labels = measure.label(read(sfturf, tile_window(y0, x0)) > self.urban_th)
+            count = tile_labels.max()
+            if count:
+                _, first = np.unique(tile_labels, return_index=True)
+                fy, fx = np.unravel_index(first[1:], tile_labels.shape)
+                bounds = np.array([(cells[0].start, cells[0].stop, cells[1].start, cells[1].stop)
+                                   for cells in find_objects(tile_labels)])
+                stats.append(np.column_stack([
+                    np.bincount(tile_labels.ravel())[1:], (fy + y0) * nx + fx + x0,
+                    bounds + [y0, y0, x0, x0],
+                ]))
+            tile_labels = np.where(tile_labels > 0, tile_labels + n_labels, 0)
+            offsets[y0, x0] = n_labels
+            edges[y0, x0] = (tile_labels[0], tile_labels[-1], tile_labels[:, 0], tile_labels[:, -1])
+            n_labels += count
+        stats = np.concatenate(stats + [np.zeros((0, 6), dtype=np.int64)]).astype(np.int64)
+
+        # Merge the labels of clusters touching across tile boundaries (8-connectivity)
+        pairs = []
+        for y0 in range(tile_size, ny, tile_size):
+            before = np.concatenate([edges[y0 - tile_size, x0][1] for x0 in range(0, nx, tile_size)])
+            after = np.concatenate([edges[y0, x0][0] for x0 in range(0, nx, tile_size)])
+            pairs += [(before, after), (before[:-1], after[1:]), (before[1:], after[:-1])]
+        for x0 in range(tile_size, nx, tile_size):
+            before = np.concatenate([edges[y0, x0 - tile_size][3] for y0 in range(0, ny, tile_size)])
+            after = np.concatenate([edges[y0, x0][2] for y0 in range(0, ny, tile_size)])
+            pairs += [(before, after), (before[:-1], after[1:]), (before[1:], after[:-1])]
+        del edges
+        source = np.concatenate([pair[0] for pair in pairs] + [np.zeros(0, dtype=np.int64)])
+        target = np.concatenate([pair[1] for pair in pairs] + [np.zeros(0, dtype=np.int64)])
+        touching = (source > 0) & (target > 0)
+        graph = coo_matrix((np.ones(touching.sum()), (source[touching], target[touching])),
+                           shape=(n_labels + 1, n_labels + 1))
+        n_components, component = connected_components(graph, directed=False)
+        # Size, first cell and bounding box of every merged cluster
+        component = component[1:]
+        size = np.bincount(component, weights=stats[:, 0], minlength=n_components).astype(np.int64)
+        first = np.full(n_components, ny * nx)
+        np.minimum.at(first, component, stats[:, 1])
+        bbox = np.tile([ny, 0, nx, 0], (n_components, 1))
+        for column, reduce in ((0, np.minimum), (1, np.maximum), (2, np.minimum), (3, np.maximum)):
+            reduce.at(bbox[:, column], component, stats[:, column + 2])
+        # Number clusters by their first cell in raster order, so that the ids
+        # do not depend on the tile size, and drop those below min_city_size
+        kept = np.flatnonzero((size >= self.min_city_size) & (size > 0))
+        kept = kept[np.argsort(first[kept])]
+
+        # Vicinity candidates of every cluster, ranked by distance in a window
+        # around the cluster extended by a (capped) halo
+        n_urban = np.zeros(kept.size, dtype=np.int64)
+        n_rural = np.zeros(kept.size, dtype=np.int64)
+        claims = []
+        for cluster, merged in enumerate(kept):
+            ymin, ymax, xmin, xmax = bbox[merged]
+            cluster_halo = halo
+            if cluster_halo is None:
+                cluster_halo = int(np.ceil(2 * np.sqrt((1 + self.ratio_r2u) * size[merged] / np.pi))) + 2
+            cluster_halo = min(cluster_halo, max_halo)
+            while True:
+                window = (slice(max(ymin - cluster_halo, 0), min(ymax + cluster_halo, ny)),
+                          slice(max(xmin - cluster_halo, 0), min(xmax + cluster_halo, nx)))
+                urban_fraction = read(sfturf, window)
+                sftlf_mask = read(sftlf_field, window) > self.sftlf_th
+                # The cluster is the component of its first cell (all its cells are in the window)
+                window_labels = measure.label(urban_fraction > self.urban_th)
+                fy, fx = divmod(int(first[merged]), nx)
+                urban = (window_labels == window_labels[fy - window[0].start, fx - window[1].start])
+                urban &= sftlf_mask
+                if not urban.any():
+                    break
+                orog = read(orog_field, window)
+                orog_mask = ((orog < self.orog_diff + orog[urban].max()) &
+                             (orog > orog[urban].min() - self.orog_diff))
+                # Cells of any urban cluster (or its buffer) are never vicinity
+                surroundings = ((urban_fraction > self.urban_th) |
+                                ((urban_fraction <= self.urban_th) &
+                                 (urban_fraction > self.urban_sur_th))) & sftlf_mask
+                distance = UrbanVicinity.vicinity_distance(
+                    self,
+                    sfturf_mask = xr.DataArray(urban, dims=(ydim, xdim)),
+                    orog_mask = orog_mask,
+                    sftlf_mask = sftlf_mask,
+                    sfturf_sur_mask = surroundings,
+                ).values
+                n_rural[cluster] = int(round(urban.sum() * self.ratio_r2u))
+                if (halo is not None or cluster_halo >= max_halo or
+                        np.isfinite(distance).sum() >= n_rural[cluster]):
+                    break
+                cluster_halo = min(2 * cluster_halo, max_halo)
+            n_urban[cluster] = urban.sum()
+            if not n_urban[cluster]:
+                continue
+            ranking = rank_vicinity(distance, np.isfinite(distance).sum())
+            wy, wx = np.unravel_index(ranking, distance.shape)
+            claims.append((np.full(ranking.size, cluster), np.arange(ranking.size),
+                           (wy + window[0].start) * nx + wx + window[1].start,
+                           distance.flat[ranking]))
+        claims.append((np.zeros(0, dtype=np.int64),) * 3 + (np.zeros(0),))
+        cluster, rank, cell, distance = [np.concatenate(claim) for claim in zip(*claims)]
+
+        # Clusters entirely over the sea are discarded
+        land = n_urban > 0
+        final = np.zeros(kept.size, dtype=np.int64)
+        final[land] = np.arange(1, land.sum() + 1)
+        relabel = np.zeros(n_components, dtype=np.int64)
+        relabel[kept] = final
+        # Global label-equivalence table: tile label -> cluster id
+        table = np.concatenate([[0], relabel[component]])
+
+        # Competing claims are resolved before the selection: cells claimed by
+        # several clusters go to the closest one, and the clusters losing them
+        # take their next candidates
+        order = np.lexsort((rank, cluster, distance))
+        need = n_rural.copy()
+        taken = set()
+        assigned_cell, assigned_cluster = [], []
+        for c, flat in zip(cluster[order], cell[order]):
+            if need[c] and flat not in taken:
+                taken.add(flat)
+                need[c] -= 1
+                assigned_cell.append(flat)
+                assigned_cluster.append(c)
+        for c in np.flatnonzero(need):
+            print(f"Warning: Only {n_rural[c] - need[c]} non-urban cells can be found "
+                  f"for cluster {final[c]} ({n_rural[c]} requested)")
+        assigned_cell = np.array(assigned_cell, dtype=np.int64)
+        assigned_cluster = final[np.array(assigned_cluster, dtype=np.int64)]
+        # Vicinity cells grouped by tile
+        tile_of = ((assigned_cell // nx) // tile_size) * len(range(0, nx, tile_size)) + \
+                  (assigned_cell % nx) // tile_size
+        order = np.argsort(tile_of, kind='stable')
+        assigned_cell, assigned_cluster, tile_of = assigned_cell[order], assigned_cluster[order], tile_of[order]
+
+        def atlas_tile(number, y0, x0):
+            window = tile_window(y0, x0)
+            tile_labels = measure.label(read(sfturf, window) > self.urban_th)
+            tile_labels = np.where(tile_labels > 0, tile_labels + offsets[y0, x0], 0)
+            is_urban = (table[tile_labels] > 0) & (read(sftlf_field, window) > self.sftlf_th)
+            cluster_id = np.where(is_urban, table[tile_labels], 0).astype(np.int32)
+            vicinity_id = np.zeros(cluster_id.shape, dtype=np.int32)
+            start, stop = np.searchsorted(tile_of, [number, number + 1])
+            cy, cx = np.divmod(assigned_cell[start:stop], nx)
+            vicinity_id[cy - y0, cx - x0] = assigned_cluster[start:stop]
+            urmask = np.full(cluster_id.shape, np.nan)
+            urmask[vicinity_id > 0] = 0
+            urmask[is_urban] = 1
+            return cluster_id, vicinity_id, urmask
+
+        # The atlas is assembled lazily, one tile at a time
+        blocks = {}
+        for number, (y0, x0) in enumerate(tiles):
+            shape = tuple(w.stop - w.start for w in tile_window(y0, x0))
+            outputs = dask.delayed(atlas_tile, nout=3)(number, y0, x0)
+            blocks[y0, x0] = [dask.array.from_delayed(output, shape, dtype=dtype)
+                              for output, dtype in zip(outputs, (np.int32, np.int32, float))]
+        cluster_id, vicinity_id, urmask = [
+            dask.array.block([[blocks[y0, x0][k] for x0 in range(0, nx, tile_size)]
+                              for y0 in range(0, ny, tile_size)])
+            for k in range(3)
+        ]
+        clusters = np.arange(1, land.sum() + 1)
+        atlas = xr.Dataset(
+            {
+                'cluster_id': ((ydim, xdim), cluster_id),
+                'vicinity_id': ((ydim, xdim), vicinity_id),
+                'urmask': ((ydim, xdim), urmask),
+                'urban_cells': ('cluster', n_urban[land]),
+                'rural_cells': ('cluster', np.bincount(assigned_cluster, minlength=clusters.size + 1)[1:]),
+            },
+            coords={**sfturf.reset_coords(drop=True).coords, **sfturf.coords, 'cluster': clusters}
+        )
+        atlas['cluster_id'].attrs['long_name'] = 'Urban cluster id (0 for non-urban cells)'
+        atlas['vicinity_id'].attrs['long_name'] = 'Id of the urban cluster owning the vicinity cell (0 for the rest)'
+        atlas = UrbanVicinity.netcdf_attrs(self, atlas)
+        atlas['urmask'].attrs['vicinity_method'] = 'distance'
+        return atlas
+
+    def hyperparameters(self) -> dict:
+        """
+        Hyperparameters that determine the urban/vicinity mask.
+        """
+        names = CITY_HYPERPARAMETERS + ["lon_city", "lat_city", "model", "domain", "urban_var"]
+        return {name: getattr(self, name) for name in names}
+
     def netcdf_attrs(self, ds):        
         """
         Add metadata to urban area file.
@@ -512,32 +1319,11 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
             ds_urban: An xarray dataset with cells representing the percentage of urban area coverage.
         '''
     
-        # Create a grid of latitude and longitude edges to define cell boundaries
-        lon_grid, lat_grid = np.meshgrid(ds['lon'].values, ds['lat'].values)
-    
         # Combine all geometries into a single geometry (in case there are multiple city polygons)
-        city_geometry = ucdb_city.geometry.unary_union
-    
-        # Create an array to store the percentage of each cell covered by the city
-        urban_data = np.zeros((ds['lat'].size, ds['lon'].size))
-    
-        # Calculate percentage for each cell
-        for i in range(ds['lat'].size):
-            for j in range(ds['lon'].size):
-                # Define the boundaries of the cell as a polygon
-                cell_poly = box(
-                    lon_grid[i, j] - 0.5 * np.diff(ds['lon'])[0],  # left
-                    lat_grid[i, j] - 0.5 * np.diff(ds['lat'])[0],  # bottom
-                    lon_grid[i, j] + 0.5 * np.diff(ds['lon'])[0],  # right
-                    lat_grid[i, j] + 0.5 * np.diff(ds['lat'])[0]   # top
-                )
+        city_geometry = ucdb_city.geometry.union_all()
     
-                # Calculate the area of intersection with the city geometry
-                intersection_area = cell_poly.intersection(city_geometry).area
-                cell_area = cell_poly.area
-    
-                # Calculate the percentage of the cell covered by the city
-                urban_data[i, j] = (intersection_area / cell_area) * 100
+        # Percentage of each cell covered by the city
+        urban_data = cell_area_coverage(ds['lon'].values, ds['lat'].values, city_geometry)
     
         # Create the final xarray dataset containing the urban percentage information
         ds_urban = xr.Dataset(
@@ -551,3 +1337,138 @@ Altitude difference (m) respects the maximum and minimum elevation of the urban
         )
         
         return ds_urban
+
+    @classmethod
+    def batch(
+        cls,
+        cities,
+        domain,
+        model,
+        *,
+        sfturf_file : str,
+        orog_file : str,
+        sftlf_file : str,
+        output_dir : str = '.',
+        drs : dict | None = None,
+        max_workers : int | None = None,
+        index_cache_dir : str | None = None,
+        cache : MaskCache | None = None,
+    ) -> pd.DataFrame:
+        """
+        Compute the urban/vicinity masks of all the cities of a domain and model.
+
+        The static fields are opened once and cropped for every city (the nearest-cell
+        index of the grid is shared by all crops). Masks are then computed in a process
+        pool and written to `output_dir` (in the DRS layout of the masks tree if `drs`
+        is given). Failures are isolated per city.
+
+        Parameters
+        ----------
+        cities : dict or str
+            Cities configuration (or path to the YAML file, e.g. selected_cities.yaml).
+        domain : str
+            CORDEX domain (e.g. 'EUR-11').
+        model : str
+            Model key in RCM_DICT (e.g. 'REMO').
+        sfturf_file : str
+            Urban fraction file of the domain/model.
+        orog_file : str
+            Orography file of the domain/model.
+        sftlf_file : str
+            Land-sea mask file of the domain/model.
+        output_dir : str
+            Directory for the urmask NetCDF files.
+        drs : dict
+            DRS facets to write the masks as '<output_dir>/<domain>-<city>/<institute>/...'
+            (see `mask_drs_path`). Flat 'urmask-...fx.nc' files in `output_dir` if None.
+        max_workers : int
+            Number of processes (0 runs the cities serially in this process).
+        index_cache_dir : str
+            Directory to store the spatial index of the grid on disk (optional).
+        cache : urclimask.mask_cache.MaskCache
+            Reuse the masks already computed for the same static files and hyperparameters.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Summary table with one row per city (status, cell counts, file and error).
+        """
+        if isinstance(cities, str):
+            with open(cities) as f:
+                cities = yaml.safe_load(f)
+        ds_sfturf = fix_360_longitudes(xr.open_dataset(sfturf_file))
+        ds_orog = fix_360_longitudes(xr.open_dataset(orog_file))
+        ds_sftlf = fix_360_longitudes(xr.open_dataset(sftlf_file))
+        res = int(domain.split('-')[1])
+        os.makedirs(output_dir, exist_ok = True)
+
+        selected = [
+            city for city in cities
+            if city != 'DEFAULT'
+            and cities[city].get('domain') == domain
+            and city.split('_')[1] == model
+            and city.split('_')[2] in ds_sfturf
+        ]
+        summary = {}
+        jobs = {}
+        keys = {}
+        for city in selected:
+            summary[city] = {'city': city, 'name': cities[city]['name'], 'status': 'error'}
+            try:
+                urban = cls(**city_hyperparameters(cities, city))
+                if drs is None:
+                    path = os.path.join(
+                        output_dir,
+                        f"urmask-{urban.urban_var}_{cities[city]['name']}-{domain}_{RCM_DICT[domain][model]}_fx.nc"
+                    )
+                else:
+                    path = os.path.join(
+                        output_dir, mask_drs_path(domain, cities[city]['name'], urban.urban_var, drs))
+                    os.makedirs(os.path.dirname(path), exist_ok = True)
+                summary[city]['path'] = path
+                if cache is not None:
+                    keys[city] = cache.key(sources = [sfturf_file, orog_file, sftlf_file],
+                                           params = urban.hyperparameters())
+                    cached = cache.get(keys[city])
+                    if cached is not None:
+                        cached.to_netcdf(path)
+                        summary[city].update(
+                            status = 'cached',
+                            urban_cells = int((cached['urmask'] == 1).sum()),
+                            rural_cells = int((cached['urmask'] == 0).sum()),
+                        )
+                        continue
+                crops = [
+                    urban.crop_area_city(ds = ds, res = res, index_cache_dir = index_cache_dir).load()
+                    for ds in (ds_sfturf[[urban.urban_var]], ds_orog, ds_sftlf)
+                ]
+                jobs[city] = (urban, *crops, path)
+            except Exception as e:
+                summary[city]['error'] = repr(e)
+
+        def collect(city, run):
+            try:
+                summary[city].update(run(), status = 'ok')
+                if cache is not None:
+                    cache.put(keys[city], summary[city]['path'])
+            except Exception as e:
+                summary[city]['error'] = repr(e)
+
+        if max_workers == 0:
+            for city, job in jobs.items():
+                collect(city, lambda: _run_batch_city(*job))
+        else:
+            with ProcessPoolExecutor(max_workers = max_workers) as executor:
+                futures = {city: executor.submit(_run_batch_city, *job) for city, job in jobs.items()}
+                for city, future in futures.items():
+                    collect(city, future.result)
+
+        summary = pd.DataFrame(
+            list(summary.values()),
+            columns = ['city', 'name', 'status', 'urban_cells', 'rural_cells', 'seconds', 'path', 'error']
+        ).set_index('city')
+        n_failed = (summary['status'] == 'error').sum()
+        n_cached = (summary['status'] == 'cached').sum()
+        print(f"{domain} {model}: {len(summary) - n_failed} masks written "
+              f"({n_cached} from cache), {n_failed} failed")
+        return summary
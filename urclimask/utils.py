@@ -1,36 +1,88 @@
 import xarray as xr
 import geopandas as gpd
+import functools
+import numpy as np
 import os
 import pandas as pd
-from shapely.geometry import Point, Polygon
-from shapely.ops import unary_union
+import shapely
+from matplotlib.collections import LineCollection
+from shapely.geometry import Point
+
+# Country of the UCDB urban centre used by default for ambiguous city names
+UCDB_DEFAULT_COUNTRY = {
+    'London': 'United Kingdom',
+    'Birmingham': 'United Kingdom',
+    'Riga': 'Latvia',
+    'Santiago': 'Chile',
+    'Barcelona': 'Spain',
+    'Dhaka': 'Bangladesh',
+    'Naples': 'Italy',
+}
+
+UCDB_FILE = 'GHS_FUA_UCD/GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2'
+
+def build_ucdb_index(root):
+    """
+    Convert the Urban Centre Database (UCDB) GeoPackage to an indexed GeoParquet file.
+
+    The GeoParquet file is in EPSG:4326 and has a bbox covering column, so
+    lookups by name, country or location only read the matching row groups.
+    It is written next to the GeoPackage and only built once.
+
+    Parameters:
+    root (str): The root directory where the UCDB GeoPackage is located.
 
-def load_ucdb_city(root, city):
+    Returns:
+    str: Path of the GeoParquet index.
+    """
+    index_file = os.path.join(root, f'{UCDB_FILE}.parquet')
+    if not os.path.exists(index_file):
+        ucdb_info = gpd.read_file(os.path.join(root, f'{UCDB_FILE}.gpkg')).to_crs(crs='EPSG:4326')
+        tmp_file = f'{index_file}.{os.getpid()}.tmp'
+        ucdb_info.sort_values('UC_NM_MN').to_parquet(tmp_file, write_covering_bbox=True,
+                                                      row_group_size=1000)
+        os.replace(tmp_file, index_file)
+    return index_file
+
+@functools.lru_cache(maxsize=256)
+def _read_ucdb(index_file, city, country, lon, lat):
+    filters = []
+    if city is not None:
+        filters.append(('UC_NM_MN', '==', city))
+    if country is not None:
+        filters.append(('CTR_MN_NM', '==', country))
+    bbox = None if lon is None else (lon, lat, lon, lat)
+    ucdb_city = gpd.read_parquet(index_file, filters=filters or None, bbox=bbox)
+    if lon is not None:
+        ucdb_city = ucdb_city[ucdb_city.intersects(Point(lon, lat))]
+    return ucdb_city.drop(columns='bbox', errors='ignore')
+
+def load_ucdb_city(root, city=None, country=None, *, lon=None, lat=None):
     """
-    Load and filter a city shapefile from the Urban Centre Database (UCDB).
+    Load and filter a city from the Urban Centre Database (UCDB).
+
+    Lookups are served from a GeoParquet index of the UCDB (built on the
+    first call, see `build_ucdb_index`) with predicate pushdown, and
+    repeated lookups are memoized in memory.
 
     Parameters:
-    root (str): The root directory where the shapefile is located.
+    root (str): The root directory where the UCDB GeoPackage is located.
     city (str): The name of the city to load.
+    country (str): Country of the city. Defaults to UCDB_DEFAULT_COUNTRY for
+        ambiguous city names.
+    lon, lat (float): Location of the city, as an alternative or in addition to its name.
 
     Returns:
     gpd.GeoDataFrame: A GeoDataFrame containing the filtered city shapefile.
     """
-    ucdb_info = gpd.read_file(root + '/GHS_FUA_UCD/GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2.gpkg')
-    ucdb_city = ucdb_info.query(f'UC_NM_MN =="{city}"').to_crs(crs='EPSG:4326')
-    if city == 'London' or city == 'Birmingham':
-        ucdb_city = ucdb_city[ucdb_city['CTR_MN_NM'] == 'United Kingdom']
-    if city == 'Riga':
-        ucdb_city = ucdb_city[ucdb_city['CTR_MN_NM'] == 'Latvia']
-    if city == 'Santiago':
-        ucdb_city = ucdb_city[ucdb_city['CTR_MN_NM'] == 'Chile']
-    if city == 'Barcelona':
-        ucdb_city = ucdb_city[ucdb_city['CTR_MN_NM'] == 'Spain']
-    if city == 'Dhaka':
-        ucdb_city = ucdb_city[ucdb_city['CTR_MN_NM'] == 'Bangladesh']
-    if city == 'Naples':
-        ucdb_city = ucdb_city[ucdb_city['CTR_MN_NM'] == 'Italy']
-    return ucdb_city
+    if country is None:
+        country = UCDB_DEFAULT_COUNTRY.get(city)
+    if (lon is None) != (lat is None):
+        raise ValueError("Both lon and lat are needed to locate a city")
+    ucdb_city = _read_ucdb(build_ucdb_index(root), city, country,
+                           None if lon is None else float(lon),
+                           None if lat is None else float(lat))
+    return ucdb_city.copy()
 
 
 def traverseDir(root, end):
@@ -101,66 +153,138 @@ def fix_360_longitudes(
         dataset[lonname] = dataset[lonname].where(lon <= 180, other=lon - 360)
     return dataset
 
+def cell_area_coverage(lon, lat, geometry):
+    """
+    Percentage of each grid cell area covered by a geometry.
+
+    All cell boxes are built at once and indexed with an STRtree. Cells
+    that do not touch the geometry are 0%, cells that touch it but not its
+    boundary are 100%, and only the cells crossed by the boundary need an
+    exact intersection, so the cost grows with the boundary length rather
+    than with the grid size.
+
+    Parameters
+    ----------
+    lon (numpy.ndarray): 1D longitudes of the cell centers (regular spacing).
+    lat (numpy.ndarray): 1D latitudes of the cell centers (regular spacing).
+    geometry (shapely.Geometry): Polygon or MultiPolygon in the same CRS as the grid.
+
+    Returns
+    -------
+    numpy.ndarray: Array (lat, lon) with the covered percentage (0-100) of each cell.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    half_lon = 0.5 * abs(lon[1] - lon[0])
+    half_lat = 0.5 * abs(lat[1] - lat[0])
+    lon_grid, lat_grid = np.meshgrid(lon, lat)
+    cells = shapely.box(
+        lon_grid - half_lon, lat_grid - half_lat,
+        lon_grid + half_lon, lat_grid + half_lat,
+    ).ravel()
+
+    coverage = np.zeros(cells.size)
+    shapely.prepare(geometry)
+    tree = shapely.STRtree(cells)
+    touching = tree.query(geometry, predicate='intersects')
+    crossing = tree.query(geometry.boundary, predicate='intersects')
+    # Cells touching the geometry without crossing its boundary are fully inside
+    coverage[np.setdiff1d(touching, crossing)] = 100.0
+    if crossing.size:
+        intersection = shapely.intersection(cells[crossing], geometry)
+        coverage[crossing] = shapely.area(intersection) / shapely.area(cells[crossing]) * 100
+    return coverage.reshape(lon_grid.shape)
+
+def cell_corners(lon, lat):
+    """
+    Corner coordinates of the cells of a rectilinear or curvilinear grid.
+
+    Corners are the average of the four surrounding cell centers. The centers
+    are linearly extrapolated one cell beyond the grid edges, so the outer
+    corners are also defined.
+
+    Parameters
+    ----------
+    lon (numpy.ndarray): 1D or 2D longitudes of the cell centers.
+    lat (numpy.ndarray): 1D or 2D latitudes of the cell centers.
+
+    Returns
+    -------
+    tuple: 2D arrays (ny + 1, nx + 1) with the longitudes and latitudes of the corners.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if lon.ndim == 1:
+        lon, lat = [
+            np.concatenate([[x[0] - (x[1] - x[0]) / 2], (x[:-1] + x[1:]) / 2, [x[-1] + (x[-1] - x[-2]) / 2]])
+            for x in (lon, lat)
+        ]
+        return np.meshgrid(lon, lat)
+
+    def corners(x):
+        x = np.concatenate([2 * x[:1] - x[1:2], x, 2 * x[-1:] - x[-2:-1]], axis=0)
+        x = np.concatenate([2 * x[:, :1] - x[:, 1:2], x, 2 * x[:, -1:] - x[:, -2:-1]], axis=1)
+        return (x[:-1, :-1] + x[1:, :-1] + x[:-1, 1:] + x[1:, 1:]) / 4
+
+    return corners(lon), corners(lat)
+
+def mask_outlines(ds, variable = 'urmask'):
+    """
+    Outlines of the urban (1) and vicinity (0) areas of a mask.
+
+    The boundaries between cells of different class are traced directly on
+    the mask array (in grid index space), polygonized and then mapped to the
+    cell corner coordinates, so the cost grows with the length of the
+    boundaries instead of the number of cells.
+
+    Parameters
+    ----------
+    ds (xr.Dataset): Dataset with the mask and its 'lon' and 'lat' coordinates
+        (1D rectilinear or 2D curvilinear).
+    variable (str): Name of the mask variable.
+
+    Returns
+    -------
+    tuple: (gdf_urban, gdf_non_urban) GeoDataFrames (EPSG:4326) with the
+        outline of the urban and vicinity areas.
+    """
+    mask = ds[variable]
+    values = mask.values
+    lon_corners, lat_corners = cell_corners(mask.lon.values, mask.lat.values)
+    if mask.lon.ndim == 2:
+        # Cells without coordinates are left out
+        values = np.where(np.isnan(mask.lon.values), np.nan, values)
+
+    def outline(in_class):
+        # Pad so that the edges of the grid are also boundaries
+        padded = np.pad(in_class, 1)
+        rows, cols = np.nonzero(padded[1:, 1:-1] != padded[:-1, 1:-1])
+        horizontal = np.stack([np.stack([cols, rows], axis=-1),
+                               np.stack([cols + 1, rows], axis=-1)], axis=1)
+        rows, cols = np.nonzero(padded[1:-1, 1:] != padded[1:-1, :-1])
+        vertical = np.stack([np.stack([cols, rows], axis=-1),
+                             np.stack([cols, rows + 1], axis=-1)], axis=1)
+        segments = shapely.linestrings(np.concatenate([horizontal, vertical]))
+        faces = shapely.get_parts(shapely.polygonize(segments))
+        # Keep the faces inside the class (the rest are holes)
+        points = shapely.get_coordinates(shapely.point_on_surface(faces)).astype(int)
+        faces = faces[in_class[points[:, 1], points[:, 0]]] if faces.size else faces
+        geometry = shapely.union_all(faces)
+
+        def to_lonlat(coords):
+            i, j = coords[:, 1].astype(int), coords[:, 0].astype(int)
+            return np.stack([lon_corners[i, j], lat_corners[i, j]], axis=-1)
+
+        return gpd.GeoDataFrame(geometry=[shapely.transform(geometry, to_lonlat)], crs='EPSG:4326')
+
+    return outline(values == 1), outline(values == 0)
+
 def plot_urban_polygon(ds, ax):
     '''
     Plots urban and non-urban polygons from a mask dataset on the given axis.
     Returns GeoDataFrames for urban and non-urban areas.
     '''
-    # Assume the mask is in the 'urmask' variable
-    mask = ds['urmask']
-    lon2d = mask.lon.values
-    lat2d = mask.lat.values
-    
-    # Create lists to store polygons for urban areas (mask == 1) and non-urban areas (mask == 0)
-    urban_polygons = []
-    non_urban_polygons = []
-    
-    if lon2d.ndim == 1:
-        dist_lat = abs(lat2d[1] - lat2d[0]) / 2
-        dist_lon = abs(lon2d[1] - lon2d[0]) / 2
-        for lon in range(len(lon2d)):
-            for lat in range(len(lat2d)):
-                square = Polygon([
-                    (round(lon2d[lon] - dist_lon, 3), round(lat2d[lat] - dist_lat, 3)),  # bottom-left corner
-                    (round(lon2d[lon] + dist_lon, 3), round(lat2d[lat] - dist_lat, 3)),  # bottom-right corner
-                    (round(lon2d[lon] + dist_lon, 3), round(lat2d[lat] + dist_lat, 3)),  # top-right corner
-                    (round(lon2d[lon] - dist_lon, 3), round(lat2d[lat] + dist_lat, 3)),  # top-left corner
-                ])
-
-                # Add the polygon to the corresponding list
-                if mask[lat, lon] == 1:
-                    urban_polygons.append(square)
-                elif mask[lat, lon] == 0:
-                    non_urban_polygons.append(square)
-    else:
-        dist_lat = abs(lat2d[1, 0] - lat2d[0, 0])/2
-        dist_lon = abs(lon2d[0, 1] - lon2d[0, 0])/2
-
-        # Iterate through the mask and generate polygons for urban (1) and non-urban (0) cells
-        for lat in range(mask.shape[0] - 1):  # Avoid the last index to prevent out-of-bounds errors
-            for lon in range(mask.shape[1] - 1):
-                # Create a polygon using the 2D lat/lon coordinates of the cell corners
-                if pd.isnull(mask.lon[lat, lon]): # If cell contains nans continue
-                    continue
-                square = Polygon([
-                    (mask.lon[lat, lon] - dist_lon, mask.lat[lat, lon] - dist_lat),          # bottom-left corner
-                    (mask.lon[lat, lon + 1] - dist_lon, mask.lat[lat, lon + 1] - dist_lat),  # bottom-right corner
-                    (mask.lon[lat + 1, lon + 1] - dist_lon, mask.lat[lat + 1, lon + 1] - dist_lat),  # top-right corner
-                    (mask.lon[lat + 1, lon] - dist_lon, mask.lat[lat + 1, lon] - dist_lat),  # top-left corner
-                ])
-                # Add the polygon to the corresponding list
-                if mask[lat, lon] == 1:
-                    urban_polygons.append(square)
-                elif mask[lat, lon] == 0:
-                    non_urban_polygons.append(square)
-                    
-    # Unite all adjacent polygons for urban (mask == 1) and non-urban (mask == 0)
-    unified_urban_polygon = unary_union(urban_polygons)
-    unified_non_urban_polygon = unary_union(non_urban_polygons)
-    # Create GeoDataFrames for the urban and non-urban polygons
-    # CRS 'EPSG:4326' specifies the WGS 84 coordinate system, which is widely used for global GPS coordinates (lat/lon)
-    gdf_urban = gpd.GeoDataFrame(geometry=[unified_urban_polygon])
-    gdf_non_urban = gpd.GeoDataFrame(geometry=[unified_non_urban_polygon])
+    gdf_urban, gdf_non_urban = mask_outlines(ds)
     # Plot the boundary of the unified non-urban polygon (in blue)
     gdf_non_urban.boundary.plot(ax=ax,color='#8A8D28', zorder=1, linewidth=2)
     # Plot the boundary of the unified urban polygon (in red) on top of the non-urban
@@ -175,89 +299,25 @@ def plot_urban_borders(ds, ax, alpha = 1, linewidth = 2):
     """
     Plot the borders of urban areas on a map.
 
+    The outlines of all the cells of each class are built at once from the
+    cell corners and drawn as a single LineCollection per class.
+
     Parameters:
     ds (xr.Dataset): The dataset containing longitude, latitude, and urban area data.
     ax (matplotlib.axes._subplots.AxesSubplot): The matplotlib axes on which to plot.
 
     """
-    lon2d = ds.lon.values
-    lat2d = ds.lat.values
-    dist_lat = lat2d[1, 0] - lat2d[0, 0]
-    dist_lon = lon2d[0, 1] - lon2d[0, 0]
-    dist_latlon = lat2d[0 ,1] - lat2d[0, 0]
-    dist_lonlat = lon2d[1, 0] - lon2d[0, 0]
-    # Overlay the cell borders and handle NaNs
-    for i in range(len(ds.lat)-1):
-        for j in range(len(ds.lon)-1):
-            lons = [lon2d[i, j], lon2d[i, j+1], lon2d[i+1, j+1], lon2d[i+1, j], lon2d[i, j]]
-            lats = [lat2d[i, j], lat2d[i, j+1], lat2d[i+1, j+1], lat2d[i+1, j], lat2d[i, j]]
-
-            lons = lons - abs(lon2d[i, j] - lon2d[i, j+1])/2              
-            lats = lats - abs(lat2d[i, j] - lat2d[i+1, j])/2
-            
-            data_cell = ds['urmask'].values[i, j]
-            
-            if data_cell == 1:
-                ax.plot(lons, lats, color='grey', zorder = 100, linewidth = linewidth, alpha = alpha)
-            elif data_cell == 0:
-                ax.plot(lons, lats, color='green', zorder = 1, linewidth = linewidth, alpha = alpha)
-
-     # Plot the rightmost column
-    for i in range(len(ds.lat) - 1):
-        lons = [lon2d[i, -1], lon2d[i + 1, -1], lon2d[i + 1, -1] + dist_lon, lon2d[i, -1] + dist_lon, lon2d[i, -1]]
-        lats = [lat2d[i, -1], lat2d[i + 1, -1], lat2d[i + 1, -1] + dist_latlon, lat2d[i, -1] + dist_latlon, lat2d[i, -1]]
-
-        lons = lons - abs(lon2d[i, -1] - lon2d[i, -1])/2 - dist_lon/2            
-        lats = lats - abs(lat2d[i, -1] - lat2d[i+1, -1])/2 
-        
-        data_cell = ds['urmask'].values[i, -1]
-    
-        if data_cell == 1:
-            ax.plot(lons, lats, color='grey', zorder=100, linewidth = linewidth, alpha = alpha)
-        elif data_cell == 0:
-            ax.plot(lons, lats, color='green', zorder=1, linewidth = linewidth, alpha = alpha)
-    
-    # Plot the topmost row
-    for j in range(len(ds.lon) - 1):
-        lons = [lon2d[-1, j], lon2d[-1, j + 1], lon2d[-1, j + 1]  + dist_lonlat, lon2d[-1, j]  + dist_lonlat, lon2d[-1, j]]
-        lats = [lat2d[-1, j], lat2d[-1, j + 1], lat2d[-1, j + 1] + dist_lat, lat2d[-1, j] + dist_lat, lat2d[-1, j]]
-
-        
-        lons = lons - abs(lon2d[-1, j] - lon2d[-1, j+1])/2           
-        lats = lats - abs(lat2d[-1, j] - lat2d[-1, j])/2 - dist_lat/2  
-        
-        data_cell = ds['urmask'].values[-1, j]
-    
-        if data_cell == 1:
-            ax.plot(lons, lats, color='red', zorder=100, linewidth=2)
-        elif data_cell == 0:
-            ax.plot(lons, lats, color='b', zorder=1, linewidth=2)
-    
-    # Plot the bottom right corner
-    lons = [
-        lon2d[-1, -1],
-        lon2d[-1, -1] + dist_lon,
-        lon2d[-1, -1] + dist_lon  + dist_lonlat,
-        lon2d[-1, -1]  + dist_lonlat,
-        lon2d[-1, -1]
-    ]
-    lats = [
-        lat2d[-1, -1],
-        lat2d[-1, -1] + dist_latlon,
-        lat2d[-1, -1] + dist_lat + dist_latlon,
-        lat2d[-1, -1] + dist_lat,
-        lat2d[-1, -1]
-    ]
-        
-    data_cell = ds['urmask'].values[-1, -1]
-
-    lons = lons - abs(lon2d[-1, -1] - lon2d[-1, -1])/2 - dist_lon/2
-    lats = lats - abs(lat2d[-1, -1] - lat2d[-1, -1])/2 - dist_lat/2  
-    
-    if data_cell == 1:
-        ax.plot(lons, lats, color='#8A8D28', zorder=100, linewidth=2)
-    elif data_cell == 0:
-        ax.plot(lons, lats, color='#A52A2A', zorder=1, linewidth=2)
+    lon_corners, lat_corners = cell_corners(ds.lon.values, ds.lat.values)
+    corners = np.stack([lon_corners, lat_corners], axis=-1)
+    # Closed outline (5 vertices) of every cell
+    outlines = np.stack([corners[:-1, :-1], corners[:-1, 1:], corners[1:, 1:],
+                         corners[1:, :-1], corners[:-1, :-1]], axis=2)
+    data = ds['urmask'].values
+    for value, color, zorder in ((1, 'grey', 100), (0, 'green', 1)):
+        collection = LineCollection(outlines[data == value], colors=color, zorder=zorder,
+                                    linewidths=linewidth, alpha=alpha)
+        ax.add_collection(collection)
+    ax.autoscale_view()
 
 
         
@@ -311,3 +371,20 @@ RCM_DICT = {
         'RegCM': 'ICTP_RegCM4-7',
     },
 }
+
+
+def model_from_rcm(domain, rcm):
+    """
+    Short model name (RCM_DICT key) of an '<institute>_<rcm>' label.
+
+    Parameters:
+    domain (str): CORDEX domain (e.g. 'EUR-11').
+    rcm (str): Institute and RCM label (e.g. 'GERICS_REMO2015').
+
+    Returns:
+    str: The RCM_DICT key (e.g. 'REMO'), or the label itself if unknown.
+    """
+    for model, label in RCM_DICT.get(domain, {}).items():
+        if label == rcm:
+            return model
+    return rcm